@@ -15,6 +15,20 @@ import requests
 import io
 import math
 import warnings
+import json
+import collections
+import concurrent.futures
+import urllib.parse
+import hashlib
+import base64
+import functools
+import wcwidth
+import requests.adapters
+import asyncio
+import copy
+import random
+import queue
+import tempfile
 
 from PIL import Image
 import numpy as np
@@ -32,7 +46,6 @@ from prompt_toolkit.history import FileHistory
 from prompt_toolkit.enums import DEFAULT_BUFFER, SEARCH_BUFFER
 from prompt_toolkit.completion import WordCompleter, Completer, CompleteEvent
 from prompt_toolkit.filters import has_focus, is_done
-from prompt_toolkit.eventloop.inputhook import set_eventloop_with_inputhook
 from prompt_toolkit.document import Document
 from prompt_toolkit.cursor_shapes import CursorShape
 
@@ -51,6 +64,14 @@ last_rows = 0
 last_cols = 0
 last = None
 cli_tokens = []
+max_fps = 30
+last_frame_time = 0
+prompt_dirty = True
+event_loop = None
+ui_thread_id = None
+max_results_per_frame = 20
+batch_window_s = 0.25
+pending_streams = []
 
 # Helper function: make sure app config is set up
 def ensure_app_config(url_file, client_file, user_file):
@@ -122,56 +143,520 @@ def clear_line(clear_len = 0):
 def clear_screen():
     sys.stdout.write('\033[2J')
 
-def draw_line(style, line_len):
-    sys.stdout.write(style + (glyphs["line"] * line_len))
+def draw_line(x, y, style, line_len):
+    screen.put(x, y, style + (glyphs["line"] * line_len))
+
+# Off-screen cell grid that everything on screen is drawn into. flush() compares it
+# with what was sent last time and writes only the cells that changed, in one write.
+# Cells are (style, character) tuples. The cells to the right of a wide character
+# or an inline image are continuation cells with an empty character.
+SCREEN_TOKEN_RE = re.compile('\033\\[([0-9;]*)m|\033\\[[0-9;?]*[A-Za-z]|[^\033]|\033')
+BLANK_CELL = ("", " ")
+CONTINUATION_CELL = ("", "")
+
+# Apply SGR parameters to a style, returns the style as one normalized SGR sequence
+@functools.lru_cache(maxsize=4096)
+def sgr_apply(style, params):
+    codes = params.split(";")
+    if style != "":
+        codes = style[2:-1].split(";") + codes
+    fg = None
+    bg = None
+    attrs = set()
+    i = 0
+    while i < len(codes):
+        code = int(codes[i]) if codes[i] != "" else 0
+        if code == 0:
+            fg = None
+            bg = None
+            attrs = set()
+        elif code >= 1 and code <= 9:
+            attrs.add(code)
+        elif code == 22:
+            attrs.discard(1)
+            attrs.discard(2)
+        elif code >= 23 and code <= 29:
+            attrs.discard(code - 20)
+        elif (code >= 30 and code <= 37) or (code >= 90 and code <= 97):
+            fg = str(code)
+        elif code == 39:
+            fg = None
+        elif (code >= 40 and code <= 47) or (code >= 100 and code <= 107):
+            bg = str(code)
+        elif code == 49:
+            bg = None
+        elif code in [38, 48]:
+            colour_len = 3 if i + 1 < len(codes) and codes[i + 1] == "5" else 5
+            colour = ";".join(codes[i:i + colour_len])
+            i += colour_len - 1
+            if code == 38:
+                fg = colour
+            else:
+                bg = colour
+        i += 1
+
+    parts = [str(attr) for attr in sorted(attrs)] + [colour for colour in [fg, bg] if colour is not None]
+    if len(parts) == 0:
+        return ""
+    return "\033[0;" + ";".join(parts) + "m"
+
+@functools.lru_cache(maxsize=65536)
+def char_width(char):
+    return max(wcwidth.wcwidth(char), 0)
+
+@functools.lru_cache(maxsize=8192)
+def line_to_cells(line):
+    cells = []
+    style = ""
+    for token in SCREEN_TOKEN_RE.finditer(line):
+        char = token.group(0)
+        if char[0] == "\033":
+            if token.group(1) is not None:
+                style = sgr_apply(style, token.group(1))
+            continue
+        width = char_width(char)
+        if width == 0:
+            # Combining characters go with the character before them
+            for cell_num in reversed(range(len(cells))):
+                if cells[cell_num][1] != "":
+                    cells[cell_num] = (cells[cell_num][0], cells[cell_num][1] + char)
+                    break
+            continue
+        cells.append((style, char))
+        if width == 2:
+            cells.append(CONTINUATION_CELL)
+    return tuple(cells)
+
+class Framebuffer:
+    def __init__(self):
+        self.resize(0, 0)
+
+    def resize(self, cols, rows):
+        self.cols = cols
+        self.rows = rows
+        self.cells = [[BLANK_CELL] * cols for _ in range(rows)]
+        self.shown = [[BLANK_CELL] * cols for _ in range(rows)]
+        self.dirty_rows = set()
+
+    # The terminal got cleared, so everything that isn't blank has to be sent again
+    def invalidate(self):
+        self.shown = [[BLANK_CELL] * self.cols for _ in range(self.rows)]
+        self.dirty_rows = set(range(self.rows))
+
+    # Send a row again even if it didn't change (e.g. because something else drew over it)
+    def invalidate_row(self, y):
+        if y >= 1 and y <= self.rows:
+            self.shown[y - 1] = [None] * self.cols
+            self.dirty_rows.add(y - 1)
+
+    def set_cells(self, x, y, cells):
+        if y < 1 or y > self.rows or x > self.cols:
+            return
+        if x < 1:
+            cells = list(cells[1 - x:])
+            for cell_num in range(len(cells)):
+                if cells[cell_num][1] != "":
+                    break
+                cells[cell_num] = BLANK_CELL
+            x = 1
+        row = self.cells[y - 1]
+        start = x - 1
+        end = min(start + len(cells), self.cols)
+        if end <= start:
+            return
+
+        # Don't leave half of a wide character on either side
+        if row[start][1] == "":
+            for cell_num in reversed(range(start)):
+                was_continuation = row[cell_num][1] == ""
+                row[cell_num] = BLANK_CELL
+                if not was_continuation:
+                    break
+        cell_num = end
+        while cell_num < self.cols and row[cell_num][1] == "":
+            row[cell_num] = BLANK_CELL
+            cell_num += 1
+
+        row[start:end] = cells[:end - start]
+        if end < start + len(cells) and cells[end - start][1] == "" and row[end - 1][1] != "":
+            row[end - 1] = BLANK_CELL
+        self.dirty_rows.add(y - 1)
+
+    def fill(self, x, y, length, style=""):
+        self.set_cells(x, y, [(style, " ")] * length)
+
+    # Draw text with ANSI colours. Inline image lines (sixel or kitty graphics) are
+    # kept as a single cell spanning width cells.
+    def put(self, x, y, text, width=None):
+        if text.startswith("\033P") or text.startswith("\033_G"):
+            self.set_cells(x, y, (("raw", text),) + (CONTINUATION_CELL,) * (width - 1))
+            return
+        cells = line_to_cells(text)
+        if width is not None and len(cells) > width:
+            if cells[width][1] == "":
+                cells = cells[:width - 1] + (BLANK_CELL,)
+            else:
+                cells = cells[:width]
+        self.set_cells(x, y, cells)
+
+    def flush(self, cursor_x, cursor_y):
+        output = []
+        current_style = None
+        for y in sorted(self.dirty_rows):
+            row = self.cells[y]
+            shown = self.shown[y]
+            if row == shown:
+                continue
+
+            x = 0
+            while x < self.cols:
+                if row[x] == shown[x]:
+                    x += 1
+                    continue
+
+                # Changed run, extended to whole wide characters and images
+                start = x
+                while start > 0 and (row[start][1] == "" or (shown[start] is not None and shown[start][1] == "")):
+                    start -= 1
+                end = x
+                while end < self.cols and (row[end] != shown[end] or row[end][1] == ""):
+                    end += 1
+
+                output.append("\033[" + str(y + 1) + ";" + str(start + 1) + "H")
+                reposition = False
+                for cell_num in range(start, end):
+                    style, char = row[cell_num]
+                    if shown[cell_num] is not None and shown[cell_num][0] == "raw" and style != "raw":
+                        output.append(image_backend.clear_row(cell_num + 1, y + 1))
+                    if char == "":
+                        continue
+                    if style == "raw":
+                        output.append(image_backend.clear_row(cell_num + 1, y + 1))
+                        output.append(char)
+                        current_style = None
+                        reposition = True
+                        continue
+                    if reposition:
+                        output.append("\033[" + str(y + 1) + ";" + str(cell_num + 1) + "H")
+                        reposition = False
+                    if style != current_style:
+                        output.append(style if style != "" else "\033[0m")
+                        current_style = style
+                    output.append(char)
+                shown[start:end] = row[start:end]
+                x = end
+        self.dirty_rows = set()
+
+        if current_style is not None and current_style != "":
+            output.append("\033[0m")
+        output.append("\033[" + str(cursor_y) + ";" + str(cursor_x) + "H")
+        sys.stdout.write("".join(output))
+        sys.stdout.flush()
+
+screen = Framebuffer()
+
+# Wakeup for the UI loop: anything that changes what's on screen calls
+# wakeup.set(), from any thread, which wakes up ui_loop() on the event loop.
+class Wakeup:
+    def __init__(self):
+        self.event = None
+        self.pending = False
+
+    def attach(self):
+        self.event = asyncio.Event()
+
+    def set(self):
+        if self.pending or event_loop is None:
+            return
+        self.pending = True
+        event_loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.pending = False
+        self.event.clear()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+wakeup = Wakeup()
+
+# Media fetching: one pooled HTTP session for all avatar and image downloads,
+# with timeouts, a download size limit and some per-host statistics
+class MediaFetcher:
+    def __init__(self, max_bytes=16 * 1024 * 1024, connect_timeout_s=5, read_timeout_s=20, pool_size=8):
+        self.max_bytes = max_bytes
+        self.timeout = (connect_timeout_s, read_timeout_s)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.host_stats = {}
+
+    def count(self, host, num_bytes, latency_s, failed):
+        with self.lock:
+            if host not in self.host_stats:
+                self.host_stats[host] = {"requests": 0, "errors": 0, "bytes": 0, "latency_s": 0.0}
+            stats = self.host_stats[host]
+            stats["requests"] += 1
+            stats["bytes"] += num_bytes
+            stats["latency_s"] += latency_s
+            if failed:
+                stats["errors"] += 1
+
+    def fetch(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        start_time = time.time()
+        content = bytearray()
+        failed = True
+        try:
+            with self.session.get(url, timeout=self.timeout, stream=True) as resp:
+                resp.raise_for_status()
+                content_length = resp.headers.get("Content-Length")
+                if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+                    raise ValueError(url + " is larger than " + str(self.max_bytes) + " bytes")
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    content.extend(chunk)
+                    if len(content) > self.max_bytes:
+                        raise ValueError(url + " is larger than " + str(self.max_bytes) + " bytes")
+            failed = False
+        finally:
+            self.count(host, len(content), time.time() - start_time, failed)
+        return bytes(content)
+
+    def fetch_image(self, url):
+        return Image.open(io.BytesIO(self.fetch(url)))
+
+# Image cache for inline media. Downloaded files are kept on disk, named by the
+# hash of their URL, and the most recently used images are kept in memory,
+# already decoded and scaled down to at most max_image_width pixels (or the width they
+# are shown at, if that is wider).
+class ImageCache:
+    def __init__(self, cache_dir, max_disk_bytes=256 * 1024 * 1024, max_images=64, max_image_width=640):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_images = max_images
+        self.max_image_width = max_image_width
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for file_name in os.listdir(self.cache_dir):
+                cache_file = os.path.join(self.cache_dir, file_name)
+                if file_name.endswith(".tmp"):
+                    # Left over from a download that didn't finish
+                    os.remove(cache_file)
+                else:
+                    self.disk_bytes += os.path.getsize(cache_file)
+
+    def file_for(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    # Remove least recently used files until the cache fits on disk again
+    def trim_disk(self):
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+        cache_files = [os.path.join(self.cache_dir, file_name) for file_name in os.listdir(self.cache_dir)
+                       if not file_name.endswith(".tmp")]
+        for cache_file in sorted(cache_files, key=os.path.getmtime):
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                file_size = os.path.getsize(cache_file)
+                os.remove(cache_file)
+                self.disk_bytes -= file_size
+            except OSError:
+                pass
+
+    # Size of a file in the cache, or 0 if it isn't there
+    def file_size(self, cache_file):
+        try:
+            return os.path.getsize(cache_file)
+        except OSError:
+            return 0
+
+    def load(self, url):
+        if self.cache_dir is not None:
+            cache_file = self.file_for(url)
+            try:
+                os.utime(cache_file)
+                with open(cache_file, "rb") as f:
+                    content = f.read()
+                with self.lock:
+                    self.disk_hits += 1
+                return content
+            except OSError:
+                pass
+
+        with self.lock:
+            self.misses += 1
+        content = media_fetcher.fetch(url)
+        if self.cache_dir is not None:
+            # Every download gets its own temp file, so two threads fetching the same image
+            # can't write into each other's file
+            temp_fd, temp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(temp_fd, "wb") as f:
+                    f.write(content)
+                with self.lock:
+                    # If another thread got there first, its file is replaced, so only count the difference
+                    self.disk_bytes -= self.file_size(cache_file)
+                    os.replace(temp_file, cache_file)
+                    self.disk_bytes += len(content)
+                    self.trim_disk()
+            except:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                raise
+        return content
+
+    # Drop an image from disk, e.g. because the download turned out to be broken
+    def forget(self, url):
+        if self.cache_dir is None:
+            return
+        cache_file = self.file_for(url)
+        with self.lock:
+            file_size = self.file_size(cache_file)
+            try:
+                os.remove(cache_file)
+                self.disk_bytes -= file_size
+            except OSError:
+                pass
+
+    def get(self, url, shown_width=0):
+        max_width = max(self.max_image_width, shown_width)
+        key = (url, max_width)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.memory_hits += 1
+                return self.images[key]
+
+        try:
+            image = Image.open(io.BytesIO(self.load(url))).convert("RGB")
+        except:
+            # Don't keep loading a broken file from disk every time the image is shown
+            self.forget(url)
+            raise
+        if image.size[0] > max_width:
+            new_height = max(int(round(image.size[1] * max_width / image.size[0])), 1)
+            image = image.resize((max_width, new_height), Image.LANCZOS)
+
+        with self.lock:
+            self.images[key] = image
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return image
+
+# How many pixels wide the image backend renders images in this column
+def column_image_width(scrollback):
+    column_width = min(scrollback.width, shutil.get_terminal_size()[0])
+    return column_width * image_backend.column_pixels()
+
+# Pick the preview version of an attachment if the column is too narrow to show
+# more detail than it has anyways
+def attachment_image_url(attachment, scrollback):
+    preview_width = 400
+    try:
+        preview_width = attachment["meta"]["small"]["width"]
+    except:
+        pass
+    if attachment.get("preview_url") is not None and column_image_width(scrollback) <= preview_width:
+        return attachment["preview_url"]
+    return attachment["url"]
 
 # Avatar tools
-avatar_cache = {}
-def get_avatar_cols(avatar_url):
-    avatar_resp = requests.get(avatar_url)
-    avatar_image = Image.open(io.BytesIO(avatar_resp.content))
-    avatar_image = avatar_image.resize((60, 60))
+AVATAR_SIZE = 60
+AVATAR_HUE_BINS = 1 + 255 // 10
+
+# Vectorized colorsys.hsv_to_rgb for an (n, 3) array of HSV values in 0..1.
+# Does the exact same float operations, so results match colorsys bit for bit.
+def hsv_to_rgb_array(hsv):
+    h, s, v = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+    i = (h * 6.0).astype(np.int64)
+    f = (h * 6.0) - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i % 6
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+    grey = s == 0.0
+    return np.stack([np.where(grey, v, r), np.where(grey, v, g), np.where(grey, v, b)], axis=1)
+
+# Colours in a hue bin, most common first. Colours that are equally common come
+# out in the same order that sorting a set of pixel tuples by count gives.
+def avatar_bin_colours(bin_pixels):
+    if len(bin_pixels) == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    packed = (bin_pixels[:, 0] << 16) | (bin_pixels[:, 1] << 8) | bin_pixels[:, 2]
+    _, first_seen, counts = np.unique(packed, return_index=True, return_counts=True)
+    by_first_seen = np.argsort(first_seen)
+    cols = [tuple(col) for col in bin_pixels[first_seen[by_first_seen]].tolist()]
+    col_counts = dict(zip(cols, counts[by_first_seen].tolist()))
+    most_common_cols = list(reversed(sorted(set(cols), key=col_counts.get)))
+    return np.array(most_common_cols, dtype=np.int64)
+
+# Work out four primary colours for an avatar image
+def avatar_image_cols(avatar_image):
+    avatar_image = avatar_image.resize((AVATAR_SIZE, AVATAR_SIZE))
     avatar_image = avatar_image.convert('RGBA').convert('RGB').convert('HSV')
-    avatar = avatar_image.load()
-
-    hue_bins = list(map(lambda x: [], range(1 + 255 // 10)))
-    hue_weights = [0.0] * (1 + 255 // 10)
-    center_x = avatar_image.size[0] / 2
-    center_y = avatar_image.size[1] / 2
-    for y in range(avatar_image.size[1]):
-        for x in range(avatar_image.size[0]):
-            x_dev = (x - center_x) / avatar_image.size[0]
-            y_dev = (y - center_y) / avatar_image.size[1]
-            center_dist = math.sqrt(math.pow(x_dev, 2.0) + math.pow(y_dev, 2.0))
-            col = avatar[x, y]
-            hue_bin = col[0] // 10
-            hue_bins[hue_bin].append(col)
-            hue_weights[hue_bin] += 0.5 + (col[1] / 255.0) * 0.5 + center_dist * 0.1 + abs(col[2] / 255.0 - 0.5) * 0.25
+    pixels = np.asarray(avatar_image, dtype=np.int64).reshape(-1, 3)
+
+    # Weight each pixel by saturation, brightness and distance from the center
+    size_y, size_x = avatar_image.size[1], avatar_image.size[0]
+    y_idx, x_idx = np.divmod(np.arange(size_x * size_y), size_x)
+    x_dev = (x_idx - size_x / 2) / size_x
+    y_dev = (y_idx - size_y / 2) / size_y
+    center_dist = np.sqrt(x_dev * x_dev + y_dev * y_dev)
+    weights = 0.5 + (pixels[:, 1] / 255.0) * 0.5 + center_dist * 0.1 + np.abs(pixels[:, 2] / 255.0 - 0.5) * 0.25
+
+    hue_idx = pixels[:, 0] // 10
+    hue_weights = np.bincount(hue_idx, weights=weights, minlength=AVATAR_HUE_BINS).tolist()
+    hue_counts = np.bincount(hue_idx, minlength=AVATAR_HUE_BINS)
+
+    # Heaviest bins last. Bins with equal weight are ordered by their pixel lists.
+    bin_order = sorted(range(AVATAR_HUE_BINS), key=lambda hue_bin: hue_weights[hue_bin])
+    filled_weights = [hue_weights[hue_bin] for hue_bin in bin_order if hue_counts[hue_bin] > 0]
+    if len(set(filled_weights)) != len(filled_weights):
+        bin_order = sorted(
+            range(AVATAR_HUE_BINS),
+            key=lambda hue_bin: (hue_weights[hue_bin], list(map(tuple, pixels[hue_idx == hue_bin].tolist())))
+        )
 
-    hues_sorted = [x for _, x in sorted(zip(hue_weights, hue_bins))]
     primary_cols = []
-    all_most_common_cols = []
-    for hue in reversed(hues_sorted[-4:]):
+    all_most_common_cols = np.zeros((0, 3), dtype=np.int64)
+    for hue_bin in reversed(bin_order[-4:]):
+        hue = pixels[hue_idx == hue_bin]
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", category=RuntimeWarning)
             try:
-                most_common_cols = list(reversed(sorted(set(hue), key=hue.count)))
-                all_most_common_cols = most_common_cols + all_most_common_cols
+                all_most_common_cols = np.concatenate((avatar_bin_colours(hue), all_most_common_cols))
+                candidate_cols = hsv_to_rgb_array(all_most_common_cols / 255.0)
+
+                # Pick the most common colour that isn't too close to one we already have
                 found_col = False
-                for test_col in np.array(all_most_common_cols):
-                    worst_difference = 100.0
+                if len(candidate_cols) > 0:
                     if len(primary_cols) > 0:
-                        for col in primary_cols:
-                            worst_difference = min(
-                                np.linalg.norm(col - np.array(colorsys.hsv_to_rgb(*test_col / 255.0))),
-                                worst_difference
-                            )
+                        differences = np.linalg.norm(
+                            candidate_cols[:, np.newaxis, :] - np.array(primary_cols)[np.newaxis, :, :],
+                            axis=2
+                        )
+                        worst_differences = np.minimum(differences.min(axis=1), 100.0)
                     else:
-                        worst_difference = 100.0
-                    if worst_difference > 0.2:
+                        worst_differences = np.full(len(candidate_cols), 100.0)
+                    distinct = np.flatnonzero(worst_differences > 0.2)
+                    if len(distinct) > 0:
                         found_col = True
-                        primary_cols.append(list(np.array(colorsys.hsv_to_rgb(*(test_col / 255.0)))))
-                        break
+                        primary_cols.append(list(candidate_cols[distinct[0]]))
                 if not found_col:
                     median_col = np.median(hue, axis=0)
                     primary_cols.append(list(np.array(colorsys.hsv_to_rgb(*(median_col / 255.0)))))
@@ -179,59 +664,296 @@ def get_avatar_cols(avatar_url):
                 primary_cols.append(primary_cols[0])
     return primary_cols
 
-def get_avatar(avatar_url):
-    if avatar_url in avatar_cache:
-        return avatar_cache[avatar_url]
-    else:
+def get_avatar_cols(avatar_url):
+    avatar_image = media_fetcher.fetch_image(avatar_url)
+    return avatar_image_cols(avatar_image)
+
+# Avatar palette cache, persisted to disk so that restarts don't need to download
+# every avatar again. Entries are evicted least recently used first, and expire
+# after ttl_s seconds (failed downloads after failure_ttl_s seconds).
+class AvatarCache:
+    def __init__(self, cache_file, max_entries=5000, ttl_s=7 * 24 * 60 * 60, failure_ttl_s=60 * 60, save_every_s=60):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.failure_ttl_s = failure_ttl_s
+        self.save_every_s = save_every_s
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.last_save = time.time()
+        self.unsaved = False
+        self.load()
+
+    def load(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as f:
+                entries = json.load(f)
+        except:
+            return
+        with self.lock:
+            for avatar_url, (stored_at, palette) in entries:
+                self.entries[avatar_url] = (stored_at, palette)
+            self.evict()
+
+    # Saves can come from several fetch threads and from quit, one at a time writes the file
+    def save(self):
+        if self.cache_file is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                entries = [[avatar_url, list(entry)] for avatar_url, entry in self.entries.items()]
+                self.last_save = time.time()
+                self.unsaved = False
+            try:
+                with open(self.cache_file + ".tmp", "w") as f:
+                    json.dump(entries, f)
+                os.replace(self.cache_file + ".tmp", self.cache_file)
+            except:
+                pass
+
+    def expired(self, entry):
+        stored_at, palette = entry
+        ttl_s = self.ttl_s if palette is not None else self.failure_ttl_s
+        return time.time() - stored_at > ttl_s
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Returns (found, palette) - palette is None for avatars that failed to load
+    def get(self, avatar_url, count=True):
+        with self.lock:
+            entry = self.entries.get(avatar_url)
+            if entry is None or self.expired(entry):
+                if count:
+                    self.misses += 1
+                return False, None
+            self.entries.move_to_end(avatar_url)
+            if count:
+                self.hits += 1
+            return True, entry[1]
+
+    def put(self, avatar_url, palette):
+        if palette is not None:
+            palette = [[float(channel) for channel in col] for col in palette]
+        with self.lock:
+            self.entries[avatar_url] = (time.time(), palette)
+            self.entries.move_to_end(avatar_url)
+            self.evict()
+            self.unsaved = True
+            save_now = time.time() - self.last_save > self.save_every_s
+            if save_now:
+                # So other threads don't also decide to save right now
+                self.last_save = time.time()
+        if save_now:
+            self.save()
+
+def avatar_ansi(avatar_cols):
+    if avatar_cols is None:
+        return ansi_rgb(0, 0, 0) + (glyphs["avatar"] * 4)  # fallback
+    avatar = ""
+    for col in avatar_cols:
+        avatar = avatar + ansi_rgb(*col) + glyphs["avatar"]
+    return avatar
+
+# Avatars that are still being fetched are printed as a marker, which Scrollback
+# swaps for the avatar (or a neutral placeholder, while it's loading) when wrapping.
+AVATAR_MARKER_RE = re.compile('\0avatar:([^\0]*)\0')
+
+def avatar_marker(avatar_url):
+    return "\0avatar:" + avatar_url + "\0"
+
+def resolve_avatar_markers(line):
+    def resolve(match):
+        found, avatar_cols = avatar_cache.get(match.group(1), count=False)
+        if not found:
+            return ansi_rgb(0.3, 0.3, 0.3) + (glyphs["avatar"] * 4)  # placeholder
+        return avatar_ansi(avatar_cols)
+    return AVATAR_MARKER_RE.sub(resolve, line)
+
+# Fixed pool of worker threads with the submit() of a ThreadPoolExecutor. The threads are
+# daemon threads (the executor's are joined at exit, whatever their daemon flag), so an API
+# call or download that is still running doesn't keep tootmage open after quitting.
+class DaemonThreadPool:
+    def __init__(self, max_workers, thread_name_prefix):
+        self.queue = queue.SimpleQueue()
+        self.threads = []
+        for worker_num in range(max_workers):
+            thread = threading.Thread(target=self.work, name=thread_name_prefix + "_" + str(worker_num), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+    def work(self):
+        while True:
+            work_item = self.queue.get()
+            if work_item is None:
+                return
+            future, function, args, kwargs = work_item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    # Waiting work is cancelled, running work is left to finish (or to end with the process)
+    def shutdown(self):
+        while True:
+            try:
+                work_item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if work_item is not None:
+                work_item[0].cancel()
+        for thread in self.threads:
+            self.queue.put(None)
+
+# Fetches avatars on a bounded pool of background threads. Requests for an
+# avatar that is already being fetched are merged into that fetch.
+class AvatarResolver:
+    def __init__(self, max_workers=4):
+        self.executor = DaemonThreadPool(max_workers, "avatar_fetch")
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def get(self, avatar_url):
+        found, avatar_cols = avatar_cache.get(avatar_url)
+        if found:
+            return avatar_ansi(avatar_cols)
+        with self.lock:
+            if avatar_url not in self.in_flight:
+                self.in_flight[avatar_url] = set()
+                self.executor.submit(self.fetch, avatar_url)
+        return avatar_marker(avatar_url)
+
+    # Tell scrollback once the avatar is available
+    def wait_for(self, avatar_url, scrollback):
+        with self.lock:
+            if avatar_url in self.in_flight:
+                self.in_flight[avatar_url].add(scrollback)
+                return
+        scrollback.avatar_ready(avatar_url)
+
+    def fetch(self, avatar_url):
         try:
             avatar_cols = get_avatar_cols(avatar_url)
-            avatar = ""
-            for col in avatar_cols:
-                avatar = avatar + ansi_rgb(*col) + glyphs["avatar"]
         except:
-            avatar = ansi_rgb(0, 0, 0) + (glyphs["avatar"] * 4)  # fallback
-        avatar_cache[avatar_url] = avatar
-        return avatar
+            avatar_cols = None
+        avatar_cache.put(avatar_url, avatar_cols)
+        with self.lock:
+            waiting = self.in_flight.pop(avatar_url)
+        for scrollback in waiting:
+            scrollback.avatar_ready(avatar_url)
+
+def get_avatar(avatar_url):
+    return avatar_resolver.get(avatar_url)
 
 # Mastodon API dict pretty printers
-def clean_text(text, style_names, style_text):
-    content_clean = re.sub(r'<a [^>]*href="([^"]+)">[^<]*</a>', r'\1', text)
-    content_clean = content_clean.replace('<span class="h-card">', style_names)
-    content_clean = content_clean.replace('</span><span class="ellipsis">', "")
-    content_clean = content_clean.replace('</span><span class="invisible">', "")
-    content_clean = re.sub(r'</span><span class="[^"]*">', '', content_clean)
-    content_clean = content_clean.replace('</span>', style_text)
-    content_clean = content_clean.replace("</p>", "\n")
-    content_clean = re.sub(r"<br[^>]*>", "\n", content_clean)
-    content_clean = html.unescape(str(re.compile(r'<.*?>').sub("", content_clean).strip()))
+# Toot HTML to styled text, in one pass over the tags. Mentions get style_names,
+# links are shown as their full URL and every line starts with style_text. With
+# style_url_nums, every link gets its number in front, the same number for the same URL.
+# Returns the text and the links (each once, in order), mentions and hashtags found on the way.
+HTML_TAG_SPLIT_RE = re.compile(r'(<[^>]*>)')
+HTML_CLASS_RE = re.compile(r'\sclass="([^"]*)"')
+HTML_HREF_RE = re.compile(r'\shref="([^"]*)"')
+
+def parse_toot_html(text, style_names, style_text, style_url_nums=None):
+    output = []
+    links = []
+    link_nums = {}
+    mentions = []
+    hashtags = []
+    anchor_type = None
+    anchor_href = ""
+    anchor_text = []
+
+    # Text and tags alternate, starting with text
+    is_tag = True
+    for part in HTML_TAG_SPLIT_RE.split(text):
+        is_tag = not is_tag
+        if not is_tag:
+            if part == "":
+                continue
+            if "&" in part:
+                part = html.unescape(part)
+            if anchor_type is None:
+                output.append(part)
+            else:
+                anchor_text.append(part)
+            continue
 
-    content_split = []
-    for line in content_clean.split("\n"):
-        content_split.append(style_text + line)
-    return "\n".join(content_split)
+        # Most tags are <span>s, which are just dropped
+        tag_start = part[:4].lower()
+        if tag_start[1] == "s":
+            continue
+        if tag_start[:3] in ("<a>", "<a ", "<a\n"):
+            classes = HTML_CLASS_RE.search(part)
+            classes = classes.group(1).split() if classes is not None else []
+            href = HTML_HREF_RE.search(part)
+            anchor_href = html.unescape(href.group(1)) if href is not None else ""
+            anchor_text = []
+            if "hashtag" in classes or 'rel="tag"' in part:
+                anchor_type = "hashtag"
+            elif "mention" in classes:
+                anchor_type = "mention"
+            else:
+                anchor_type = "link"
+        elif tag_start == "</a>":
+            if anchor_type is not None:
+                label = "".join(anchor_text)
+                if anchor_type == "mention":
+                    output.append(style_names + label + style_text)
+                    mentions.append(label)
+                elif anchor_type == "hashtag":
+                    output.append(label)
+                    hashtags.append(label.lstrip("#"))
+                else:
+                    url = anchor_href if anchor_href != "" else label
+                    url_num = link_nums.get(url)
+                    if url_num is None:
+                        url_num = len(links)
+                        link_nums[url] = url_num
+                        links.append(url)
+                    if style_url_nums is not None:
+                        output.append(style_url_nums + "(" + str(url_num) + ")" + style_text + " " + url)
+                    else:
+                        output.append(url)
+                anchor_type = None
+        elif tag_start == "</p>" or tag_start[:3] == "<br":
+            output.append("\n")
 
-def number_urls(text, status, style_url_nums, style_text):
-    urls = re.findall(
-        r'http[s]?://(?:[a-zA-Z0-9$-_@.&+!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
-        text
-    )
-    url_num = 0
-    replaced_urls = []
+    # An <a> that never got closed
+    if anchor_type is not None:
+        output.append("".join(anchor_text))
 
-    # URLs in text
-    for url in urls:
-        if url not in replaced_urls:
-            text = text.replace(url, style_url_nums + "(" + str(url_num) + ")" + style_text + " " + url)
-            replaced_urls.append(url)
-            url_num += 1
+    content_clean = "".join(output).strip()
+    styled = style_text + content_clean.replace("\n", "\n" + style_text)
+    return styled, links, mentions, hashtags
 
-    # Attachments
-    if not status is None:
-        for attachment in status["media_attachments"]:
-            if attachment["type"] in ["image", "video", "gifv", "audio"]:
-                text = text + " " + style_url_nums + "(" + str(url_num) + ")" + style_text + " " + glyphs[attachment["type"]]
-                url_num += 1
-    return text, replaced_urls
+def clean_text(text, style_names, style_text):
+    return parse_toot_html(text, style_names, style_text)[0]
+
+# Attachments are numbered after the links, starting at url_num
+def number_attachments(text, status, url_num, style_url_nums, style_text):
+    for attachment in status["media_attachments"]:
+        if attachment["type"] in ["image", "video", "gifv", "audio"]:
+            text = text + " " + style_url_nums + "(" + str(url_num) + ")" + style_text + " " + glyphs[attachment["type"]]
+            url_num += 1
+    return text
 
 
 def image_to_ansi_blocky(image, width=80):
@@ -244,100 +966,350 @@ def image_to_ansi_blocky(image, width=80):
     new_height = max(new_height, 1)
     resized = image.resize((width, new_height), Image.LANCZOS)
 
-    # Build ANSI output
+    # Top and bottom pixel of every cell, odd heights get a black bottom row
+    pixels = np.asarray(resized, dtype=np.uint8)
+    if new_height % 2 == 1:
+        pixels = np.concatenate((pixels, np.zeros((1, width, 3), dtype=np.uint8)))
+    tops = pixels[0::2]
+    bottoms = pixels[1::2]
+
+    # Colours only need to be set where they differ from the cell to the left
+    fg_changed = np.ones((tops.shape[0], width), dtype=bool)
+    fg_changed[:, 1:] = np.any(tops[:, 1:] != tops[:, :-1], axis=2)
+    bg_changed = np.ones((tops.shape[0], width), dtype=bool)
+    bg_changed[:, 1:] = np.any(bottoms[:, 1:] != bottoms[:, :-1], axis=2)
+
+    # Build ANSI output, one run of same coloured cells at a time
     lines = []
-    for y in range(0, new_height, 2):
+    for top_row, bottom_row, fg_row, bg_row in zip(tops.tolist(), bottoms.tolist(), fg_changed, bg_changed):
+        run_starts = np.flatnonzero(fg_row | bg_row).tolist() + [width]
+        fg_row = fg_row.tolist()
+        bg_row = bg_row.tolist()
         row_chars = []
-        y_next = y + 1
-        for x in range(width):
-            r_top, g_top, b_top = resized.getpixel((x, y))
-            if y_next < new_height:
-                r_bot, g_bot, b_bot = resized.getpixel((x, y_next))
+        for x, x_next in zip(run_starts, run_starts[1:]):
+            if fg_row[x] and bg_row[x]:
+                row_chars.append("\033[38;2;{};{};{};48;2;{};{};{}m".format(*top_row[x], *bottom_row[x]))
+            elif fg_row[x]:
+                row_chars.append("\033[38;2;{};{};{}m".format(*top_row[x]))
             else:
-                r_bot, g_bot, b_bot = (0, 0, 0)
-            row_chars.append(
-                f"\033[38;2;{r_top};{g_top};{b_top}m"
-                f"\033[48;2;{r_bot};{g_bot};{b_bot}m▀"
-            )
+                row_chars.append("\033[48;2;{};{};{}m".format(*bottom_row[x]))
+            row_chars.append("▀" * (x_next - x))
         row_chars.append("\033[0m")
         lines.append("".join(row_chars))
     return lines
 
-def pprint_status(result_prefix, result, scrollback, cw=False, images=False):
-    content_clean = ""
-    if result.spoiler_text is not None and len(result.spoiler_text) > 0:
-        content_clean = theme["cw"] + "[CW: " + result.spoiler_text + "] "
-    if not cw or result.spoiler_text is None or len(result.spoiler_text) == 0:
-        content_clean += clean_text(result["content"], theme["names_inline"], theme["text"])
-    content_clean, result["__urls"] = number_urls(content_clean, result, theme["url_nums"], theme["text"])
+# Inline image output. Half-blocks work everywhere, sixel and kitty graphics look
+# better and need fewer bytes on terminals that support them. Every backend renders
+# an image to one string per text row, so images scroll and clear like text.
+def terminal_cell_pixels(default=(10, 20)):
+    try:
+        import fcntl
+        import termios
+        import struct
+        rows, cols, x_pixels, y_pixels = struct.unpack(
+            "HHHH",
+            fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b"\0" * 8)
+        )
+        if rows > 0 and cols > 0 and x_pixels > 0 and y_pixels > 0:
+            return (x_pixels // cols, y_pixels // rows)
+    except:
+        pass
+    return default
+
+# Scale image to width text columns, padded with black to a whole number of rows
+def image_to_cell_canvas(image, width, cell_w, cell_h):
+    image = image.convert("RGB")
+    pixel_w = width * cell_w
+    pixel_h = max(int(round(pixel_w * image.size[1] / image.size[0])), 1)
+    rows = int(math.ceil(pixel_h / cell_h))
+    canvas = Image.new("RGB", (pixel_w, rows * cell_h))
+    canvas.paste(image.resize((pixel_w, pixel_h), Image.LANCZOS), (0, 0))
+    return canvas, rows
 
-    time_formatted = datetime.datetime.strftime(result["created_at"], '%H:%M:%S')
-    status_icon = glyphs[result["visibility"]]
+class HalfBlockImages:
+    name = "halfblock"
 
-    avatar = get_avatar(result["account"]["avatar_static"])
+    def render(self, image, width):
+        return image_to_ansi_blocky(image, width)
 
-    scrollback.print(
-        theme["ids"] + result_prefix + theme["names"] + result["account"]["acct"]
-        + theme["dates"] + " @ " + time_formatted,
-        theme["visibility"] + status_icon
-    )
-    scrollback.print(avatar + " " + content_clean + " ")
+    # One pixel per column, two per row
+    def column_pixels(self):
+        return 1
+
+    def clear_row(self, x, y):
+        return ""
+
+SIXEL_RUN_RE = re.compile(r"(.)\1{3,}")
+
+def sixel_encode(indices, palette):
+    height, width = indices.shape
+    sixel = ['\033Pq"1;1;' + str(width) + ";" + str(height)]
+    for col in np.unique(indices).tolist():
+        r, g, b = (palette[col] * 100 // 255).tolist()
+        sixel.append("#{};2;{};{};{}".format(col, r, g, b))
+
+    bands = []
+    for band_start in range(0, height, 6):
+        band = indices[band_start:band_start + 6]
+        bit_values = (1 << np.arange(band.shape[0]))[:, np.newaxis]
+        band_cols = []
+        for col in np.unique(band).tolist():
+            sixels = ((band == col) * bit_values).sum(axis=0) + 63
+            data = sixels.astype(np.uint8).tobytes().decode("ascii").rstrip("?")
+            data = SIXEL_RUN_RE.sub(lambda run: "!" + str(len(run.group(0))) + run.group(1), data)
+            band_cols.append("#" + str(col) + data)
+        bands.append("$".join(band_cols))
+    sixel.append("-".join(bands))
+    sixel.append("\033\\")
+    return "".join(sixel)
+
+class SixelImages:
+    name = "sixel"
+
+    def __init__(self, colors=64, cell_pixels=None):
+        self.colors = colors
+        self.cell_pixels = cell_pixels
+
+    def render(self, image, width):
+        # Sixels can't be scaled, so they have to be exactly one cell high
+        cell_w, cell_h = self.cell_pixels or terminal_cell_pixels()
+        canvas, rows = image_to_cell_canvas(image, width, cell_w, cell_h)
+        quantized = canvas.quantize(colors=self.colors)
+        palette = np.array(quantized.getpalette()[:3 * 256], dtype=np.int64).reshape(-1, 3)
+        indices = np.asarray(quantized)
+        lines = []
+        for row in range(rows):
+            lines.append(sixel_encode(indices[row * cell_h:(row + 1) * cell_h], palette))
+        return lines
+
+    def column_pixels(self):
+        return (self.cell_pixels or terminal_cell_pixels())[0]
+
+    def clear_row(self, x, y):
+        return ""
+
+class KittyImages:
+    name = "kitty"
+
+    # The terminal scales every row to fit its cells, so images can be sent at lower resolution
+    def __init__(self, cell_pixels=(2, 4)):
+        self.cell_pixels = cell_pixels
+        self.next_id = 1
+
+    def render(self, image, width):
+        cell_w, cell_h = self.cell_pixels
+        canvas, rows = image_to_cell_canvas(image, width, cell_w, cell_h)
+        lines = []
+        for row in range(rows):
+            png = io.BytesIO()
+            canvas.crop((0, row * cell_h, canvas.size[0], (row + 1) * cell_h)).save(png, format="PNG")
+            data = base64.standard_b64encode(png.getvalue()).decode("ascii")
+
+            # Transmit and place at the cursor, without replies and without moving the cursor
+            image_id = self.next_id
+            self.next_id += 1
+            chunks = [data[pos:pos + 4096] for pos in range(0, len(data), 4096)]
+            line = []
+            for chunk_num, chunk in enumerate(chunks):
+                more = int(chunk_num < len(chunks) - 1)
+                if chunk_num == 0:
+                    line.append("\033_Ga=T,f=100,i={},p=1,c={},r=1,C=1,q=2,m={};{}\033\\".format(image_id, width, more, chunk))
+                else:
+                    line.append("\033_Gm={};{}\033\\".format(more, chunk))
+            lines.append("".join(line))
+        return lines
+
+    def column_pixels(self):
+        return self.cell_pixels[0]
+
+    # Images aren't removed by overwriting them with text, so remove them explicitly
+    def clear_row(self, x, y):
+        return "\033_Ga=d,d=P,x={},y={},q=2\033\\".format(x, y)
+
+# Pick a backend based on the terminal, or force one ("halfblock", "sixel", "kitty")
+def select_image_backend(mode="auto"):
+    if mode == "auto":
+        term = os.environ.get("TERM", "")
+        term_program = os.environ.get("TERM_PROGRAM", "")
+        if term in ["xterm-kitty", "xterm-ghostty"] or "KITTY_WINDOW_ID" in os.environ:
+            mode = "kitty"
+        elif "sixel" in term or term in ["mlterm", "foot", "foot-extra", "yaft-256color"] or term_program in ["WezTerm", "mintty"]:
+            mode = "sixel"
+        else:
+            mode = "halfblock"
+    backends = {
+        "halfblock": HalfBlockImages,
+        "sixel": SixelImages,
+        "kitty": KittyImages,
+    }
+    return backends[mode]()
+
+# Rendered images, per image and width, so that redraws don't resample them again.
+# Bounded by the (approximate) memory the rendered lines take up.
+class RenderedImageCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, image, width):
+        # PIL images aren't hashable, so key on id() and hold on to the image so the id stays unique
+        key = (id(image), width, image_backend.name)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][1]
+
+        self.misses += 1
+        lines = image_backend.render(image, width)
+        size = sum(map(sys.getsizeof, lines))
+        self.entries[key] = (image, lines, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+        return lines
+
+# Formatted statuses, so a status that shows up again (in another column, in an
+# expanded conversation, ...) doesn't get formatted again. Keyed by status id, edit
+# time and cw flag; changing the theme empties the cache. Lines are stored without
+# the result number, which differs per column. Entries with avatars that are still
+# loading aren't kept, since their markers could outlive the cached avatar.
+class StatusRenderCache:
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.theme = None
+        self.hits = 0
+        self.misses = 0
+
+    # Returns (lines, urls) or None, lines are (line, right_side) pairs
+    def get(self, key):
+        with self.lock:
+            if self.theme is not theme:
+                self.entries.clear()
+                self.theme = theme
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, lines, urls):
+        entry = (lines, urls)
+        if any(AVATAR_MARKER_RE.search(line) is not None for line, _ in lines):
+            return entry
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def __repr__(self):
+        return "<StatusRenderCache {} entries, {} hits, {} misses, {:.0%} hit rate>".format(
+            len(self.entries), self.hits, self.misses, self.hit_rate())
+
+# Prints lines from the render cache, the first one after the result number
+def print_rendered(result_prefix, lines, scrollback):
+    scrollback.print(theme["ids"] + result_prefix + lines[0][0], lines[0][1])
+    for line, right_side in lines[1:]:
+        scrollback.print(line, right_side)
+
+def print_attachments(attachments, scrollback):
+    for attachment in attachments:
+        if attachment["type"] == "image":
+            try:
+                image = image_cache.get(attachment_image_url(attachment, scrollback), column_image_width(scrollback))
+                scrollback.print(image)
+            except:
+                scrollback.print("Error loading image\n")
+
+def pprint_status(result_prefix, result, scrollback, cw=False, images=False):
+    key = ("status", result["id"], result.get("edited_at"), bool(cw))
+    rendered = status_render_cache.get(key)
+    if rendered is None:
+        content_clean = ""
+        urls = []
+        if result.spoiler_text is not None and len(result.spoiler_text) > 0:
+            content_clean = theme["cw"] + "[CW: " + result.spoiler_text + "] "
+        if not cw or result.spoiler_text is None or len(result.spoiler_text) == 0:
+            content, urls = parse_toot_html(result["content"], theme["names_inline"], theme["text"], theme["url_nums"])[:2]
+            content_clean += content
+        content_clean = number_attachments(content_clean, result, len(urls), theme["url_nums"], theme["text"])
+
+        time_formatted = datetime.datetime.strftime(result["created_at"], '%H:%M:%S')
+        status_icon = glyphs[result["visibility"]]
+
+        avatar = get_avatar(result["account"]["avatar_static"])
+
+        rendered = status_render_cache.put(key, [
+            (theme["names"] + result["account"]["acct"] + theme["dates"] + " @ " + time_formatted,
+             theme["visibility"] + status_icon),
+            (avatar + " " + content_clean + " ", None),
+        ], urls)
+    lines, result["__urls"] = rendered
+    print_rendered(result_prefix, lines, scrollback)
 
     if images:
         if "media_attachments" in result:
-            for attachment in result["media_attachments"]:
-                if attachment["type"] == "image":
-                    try:
-                        image_url = attachment["url"]
-                        image_resp = requests.get(image_url)
-                        image = Image.open(io.BytesIO(image_resp.content))
-                        scrollback.print(image)
-                    except:
-                        scrollback.print("Error loading image\n")
+            print_attachments(result["media_attachments"], scrollback)
 
     scrollback.print("")
     return
 
 def pprint_reblog(result_prefix, result, scrollback, cw=False, images=False):
-    content_clean = ""
-    if result.reblog.spoiler_text is not None and len(result.reblog.spoiler_text) > 0:
-        content_clean = theme["cw"] + "[CW: " + result.reblog.spoiler_text + "] "
-    if not cw or result.reblog.spoiler_text is None or len(result.reblog.spoiler_text) == 0:
-        content_clean += clean_text(result.reblog["content"], theme["names_inline"], theme["text"])
-    content_clean, result["__urls"] = number_urls(content_clean, result.reblog, theme["url_nums"], theme["text"])
-
-    time_formatted = datetime.datetime.strftime(result["created_at"], '%H:%M:%S')
-
-    avatar = get_avatar(result["account"]["avatar_static"])
-    avatar_orig = get_avatar(result["reblog"]["account"]["avatar_static"])
+    key = ("reblog", result["id"], result.reblog.get("edited_at"), bool(cw))
+    rendered = status_render_cache.get(key)
+    if rendered is None:
+        content_clean = ""
+        urls = []
+        if result.reblog.spoiler_text is not None and len(result.reblog.spoiler_text) > 0:
+            content_clean = theme["cw"] + "[CW: " + result.reblog.spoiler_text + "] "
+        if not cw or result.reblog.spoiler_text is None or len(result.reblog.spoiler_text) == 0:
+            content, urls = parse_toot_html(result.reblog["content"], theme["names_inline"], theme["text"], theme["url_nums"])[:2]
+            content_clean += content
+        content_clean = number_attachments(content_clean, result.reblog, len(urls), theme["url_nums"], theme["text"])
+
+        time_formatted = datetime.datetime.strftime(result["created_at"], '%H:%M:%S')
+
+        avatar = get_avatar(result["account"]["avatar_static"])
+        avatar_orig = get_avatar(result["reblog"]["account"]["avatar_static"])
+
+        rendered = status_render_cache.put(key, [
+            (theme["names"] + result["account"]["acct"] + theme["dates"] + " @ " + time_formatted, None),
+            (avatar + " " + theme["reblog"] + glyphs["reblog"] + " " + avatar_orig
+             + " " + theme["names"] + result["reblog"]["account"]["acct"], None),
+            (content_clean, None),
+        ], urls)
+    lines, result["__urls"] = rendered
+    print_rendered(result_prefix, lines, scrollback)
 
-    scrollback.print(theme["ids"] + result_prefix + theme["names"] + result["account"]["acct"]
-                     + theme["dates"] + " @ " + time_formatted)
-    scrollback.print(avatar + " " + theme["reblog"] + glyphs["reblog"] + " " + avatar_orig
-                     + " " + theme["names"] + result["reblog"]["account"]["acct"])
-    scrollback.print(content_clean)
     if images:
         if "media_attachments" in result.reblog:
-            for attachment in result.reblog["media_attachments"]:
-                if attachment["type"] == "image":
-                    try:
-                        image_url = attachment["url"]
-                        image_resp = requests.get(image_url)
-                        image = Image.open(io.BytesIO(image_resp.content))
-                        scrollback.print(image)
-                    except:
-                        scrollback.print("Error loading image\n")
+            print_attachments(result.reblog["media_attachments"], scrollback)
 
     scrollback.print("")
     return
 
 def pprint_notif(result_prefix, result, scrollback, cw=False):
     content_clean = ""
+    urls = []
     if result.status.spoiler_text is not None and len(result.status.spoiler_text) > 0:
         content_clean = theme["cw_notif"] + "[CW: " + result.status.spoiler_text + "] "
     if not cw or result.status.spoiler_text is None or len(result.status.spoiler_text) == 0:
-        content_clean += clean_text(result["status"]["content"], theme["names_notif"], theme["text_notif"])
-    content_clean, result["__urls"] = number_urls(content_clean, None, theme["url_nums"], theme["text_notif"])
+        content, urls = parse_toot_html(result["status"]["content"], theme["names_notif"], theme["text_notif"], theme["url_nums"])[:2]
+        content_clean += content
+    result["__urls"] = urls
 
     time_formatted = datetime.datetime.strftime(result["created_at"], '%H:%M:%S')
 
@@ -363,8 +1335,7 @@ def pprint_follow(result_prefix, result, scrollback):
     return
 
 def pprint_account(result_prefix, result, scrollback, cw=False):
-    content_clean = clean_text(result["note"], theme["names_inline"], theme["text"])
-    content_clean, result["__urls"] = number_urls(content_clean, None, theme["url_nums"], theme["text"])
+    content_clean, result["__urls"] = parse_toot_html(result["note"], theme["names_inline"], theme["text"], theme["url_nums"])[:2]
 
     time_formatted = datetime.datetime.strftime(result["created_at"], '%H:%M:%S %d %b %Y')
     avatar = get_avatar(result["avatar_static"])
@@ -440,10 +1411,95 @@ def align(left_part, right_part, width):
             return result
     return unserwrap.wrap(left_part + " " + right_part, width)
 
-# Scrollback column with internal "result history" buffer
+# Keys a result can be found by in a column: its own ID, and the ID of the status
+# inside a boost or notification. The first key is the result's own. IDs are kept
+# as strings, since stream delete events and API results don't always agree on the type.
+def result_keys(result):
+    keys = []
+    if isinstance(result, dict) and "id" in result:
+        if "content" in result:
+            keys.append(("status", str(result["id"])))
+            if result.get("reblog") is not None:
+                keys.append(("status", str(result["reblog"]["id"])))
+        elif "type" in result:
+            keys.append(("notification", str(result["id"])))
+            if result.get("status") is not None:
+                keys.append(("status", str(result["status"]["id"])))
+    return keys
+
+# When the result (or the status inside it) was last edited, None if never
+def result_edited_at(result):
+    for part in (result, result.get("reblog"), result.get("status")):
+        if isinstance(part, dict) and part.get("edited_at") is not None:
+            return part["edited_at"]
+    return None
+
+# Lines a result was printed as in a column: line_count lines starting at line
+# number first_serial (counted since the column was created)
+class ResultSpan:
+    def __init__(self, first_serial, line_count, result, number, keys):
+        self.first_serial = first_serial
+        self.line_count = line_count
+        self.result = result
+        self.number = number
+        self.keys = keys
+
+# Collects what pprint_result prints, as (line, right_side) pairs
+class LineCapture:
+    def __init__(self):
+        self.lines = []
+
+    def print(self, x, right_side=None):
+        if isinstance(x, str):
+            for line in x.split("\n"):
+                self.lines.append((line, right_side))
+
+# List with constant time indexing that drops entries from the front in amortized
+# constant time: dropped entries are only cleared, and removed in bulk once they
+# make up half of the list.
+class LineRing:
+    def __init__(self):
+        self.entries = []
+        self.head = 0
+
+    def __len__(self):
+        return len(self.entries) - self.head
+
+    def __getitem__(self, index):
+        return self.entries[self.head + index]
+
+    def append(self, entry):
+        self.entries.append(entry)
+
+    def popleft(self):
+        entry = self.entries[self.head]
+        self.entries[self.head] = None
+        self.head += 1
+        if self.head * 2 >= len(self.entries):
+            del self.entries[:self.head]
+            self.head = 0
+        return entry
+
+    # Entries start to end (or to the last one)
+    def slice(self, start, end=None):
+        end = len(self) if end is None else end
+        return self.entries[self.head + start:self.head + end]
+
+# Scrollback column with internal "result history" buffer. Lines are kept in a
+# bounded LineRing together with their wrapped version and the running total of
+# wrapped lines up to and including them, as [line, right_side, wrapped, wrapped_end].
 class Scrollback:
-    def __init__(self, title, offset, width, expand_unknown=False):
-        self.scrollback = []
+    def __init__(self, title, offset, width, expand_unknown=False, max_lines=3000, max_pending=500):
+        self.scrollback = LineRing()
+        self.max_lines = max_lines
+        self.incoming_results = collections.deque(maxlen=max_pending)
+        self.incoming_prints = collections.deque()
+        self.incoming_changes = collections.deque()
+        self.deleted_keys = collections.OrderedDict()
+        self.incoming_since = 0
+        self.results_dropped = 0
+        self.results_coalesced = 0
+        self.dropped_shown = 0
         self.dirty = True
         self.pos = 0
         self.added = False
@@ -454,8 +1510,15 @@ class Scrollback:
         self.result_history = []
         self.result_counter = -1
         self.full_redraw = True
-        self.wrapped_cache = []
+        self.wrapped_count = 0
+        self.wrapped_base = 0
         self.expand_unknown = expand_unknown
+        self.lines_dropped = 0
+        self.avatar_lines = {}
+        self.avatars_ready = []
+        self.rewrap_serials = []
+        self.result_index = collections.OrderedDict()
+        self.results_duplicate = 0
 
     def needs_redraw(self):
         return self.full_redraw or self.dirty
@@ -463,50 +1526,332 @@ class Scrollback:
     def set_active(self, active):
         self.active = active
         self.full_redraw = True
+        wakeup.set()
 
     def add_result(self, result):
+        keys = result_keys(result)
+        for key in keys:
+            if key in self.deleted_keys:
+                return
+        span = self.own_span(keys)
+        if span is not None:
+            # Already in the column: edits are redrawn in place, repeats are dropped
+            if result_edited_at(result) != result_edited_at(span.result):
+                self.replace_result(span, result)
+            else:
+                self.results_duplicate += 1
+            return
+        if len(keys) > 0 and keys[0] in self.result_index:
+            # Only shown inside a boost or notification so far, which get the edit (if
+            # there is one) and keep showing it that way
+            if result_edited_at(result) != result_edited_at(self.result_index[keys[0]][0].result):
+                self.update_status(result)
+
         self.result_counter = (self.result_counter + 1) % 1000
         if len(self.result_history) > self.result_counter:
             self.result_history[self.result_counter] = result
         else:
             self.result_history.append(result)
+        first_serial = self.lines_dropped + len(self.scrollback)
         pprint_result(result, self, str(self.result_counter), cw=True, expand_unknown = self.expand_unknown)
 
+        if len(keys) > 0:
+            line_count = self.lines_dropped + len(self.scrollback) - first_serial
+            span = ResultSpan(first_serial, line_count, result, self.result_counter, keys)
+            for key in keys:
+                self.result_index.setdefault(key, []).append(span)
+            self.prune_result_index()
+
+    # The span that shows this result itself (not a boost or notification that contains it)
+    def own_span(self, keys):
+        if len(keys) == 0:
+            return None
+        for span in self.result_index.get(keys[0], []):
+            if span.keys[0] == keys[0]:
+                return span
+        return None
+
+    # True if a result with the same ID is already in the column
+    def has_result(self, result):
+        return self.own_span(result_keys(result)) is not None
+
+    # Forget results whose lines have all been dropped
+    def prune_result_index(self):
+        while len(self.result_index) > 0:
+            key, spans = next(iter(self.result_index.items()))
+            spans[:] = [span for span in spans if span.first_serial + span.line_count > self.lines_dropped]
+            if len(spans) > 0 and len(self.result_index) <= self.max_lines:
+                break
+            self.result_index.popitem(last=False)
+
+    # Redraw a result in place of its old lines
+    def replace_result(self, span, result):
+        if span.first_serial < self.lines_dropped:
+            return
+        capture = LineCapture()
+        pprint_result(result, capture, str(span.number), cw=True, expand_unknown = self.expand_unknown)
+        self.set_span_lines(span, capture.lines)
+        self.set_history_slot(span, result)
+        span.result = result
+
+    # Point the span's result history slot at a new result. Commands replace result_history
+    # with their own results, so the slot may be gone or hold something else by now
+    def set_history_slot(self, span, result):
+        if span.number < len(self.result_history) and self.result_history[span.number] is span.result:
+            self.result_history[span.number] = result
+
+    # Remove all results with this key (e.g. ("status", id)) from the column
+    def remove_results(self, key):
+        for span in list(self.result_index.get(key, [])):
+            self.set_span_lines(span, [])
+            self.set_history_slot(span, None)
+            for span_key in span.keys:
+                spans = self.result_index.get(span_key, [])
+                if span in spans:
+                    spans.remove(span)
+                if len(spans) == 0:
+                    self.result_index.pop(span_key, None)
+
+    # Apply an edited status to every result in the column that shows it
+    def update_status(self, status):
+        for span in list(self.result_index.get(("status", str(status["id"])), [])):
+            if span.keys[0] == ("status", str(status["id"])):
+                result = status
+            else:
+                # Boost or notification: keep it, with the new status inside
+                result = copy.copy(span.result)
+                result["reblog" if "content" in result else "status"] = status
+            self.replace_result(span, result)
+
+    # Remove a deleted status, and remember it in case it is still queued somewhere
+    def delete_status(self, status_id):
+        key = ("status", str(status_id))
+        self.deleted_keys[key] = True
+        while len(self.deleted_keys) > 1000:
+            self.deleted_keys.popitem(last=False)
+        self.remove_results(key)
+
+    # Put new lines into the entries of a span. Entries that aren't needed anymore are
+    # hidden (they wrap to nothing), extra lines go into the last entry. Only these
+    # entries are rewrapped on the next draw. Entries that were already dropped are skipped.
+    def set_span_lines(self, span, lines):
+        first_index = span.first_serial - self.lines_dropped
+        for line_num in range(max(-first_index, 0), span.line_count):
+            entry = self.scrollback[first_index + line_num]
+            if isinstance(entry[0], Image.Image):
+                continue
+            if line_num < span.line_count - 1:
+                entry[0], entry[1] = lines[line_num] if line_num < len(lines) else (None, None)
+            else:
+                rest = lines[line_num:]
+                if len(rest) == 0:
+                    entry[0], entry[1] = None, None
+                elif len(rest) == 1:
+                    entry[0], entry[1] = rest[0]
+                else:
+                    entry[0], entry[1] = "\n".join(line for line, right_side in rest), None
+            if entry[0] is not None:
+                for avatar_url in AVATAR_MARKER_RE.findall(entry[0]):
+                    self.avatar_lines.setdefault(avatar_url, []).append(span.first_serial + line_num)
+                    avatar_resolver.wait_for(avatar_url, self)
+            self.rewrap_serials.append(span.first_serial + line_num)
+        self.dirty = True
+        wakeup.set()
+
+    # Queue a result to be formatted by the UI loop. Safe to call from any thread. If the
+    # UI loop falls behind, the oldest queued results are dropped (and counted).
+    def push_result(self, result):
+        if len(self.incoming_results) == 0:
+            self.incoming_since = time.time()
+        if len(self.incoming_results) == self.incoming_results.maxlen:
+            self.results_dropped += 1
+        self.incoming_results.append(result)
+        if len(self.incoming_results) == 1 or len(self.incoming_results) == max_results_per_frame:
+            wakeup.set()
+
+    # Time at which queued results should be formatted, None if there are none. Results are
+    # collected for batch_window_s, or until a full batch is waiting, and then formatted together
+    def incoming_due(self):
+        if len(self.incoming_prints) > 0 or len(self.incoming_changes) > 0 or len(self.incoming_results) >= max_results_per_frame:
+            return 0
+        if len(self.incoming_results) == 0:
+            return None
+        return self.incoming_since + batch_window_s
+
+    def incoming_ready(self):
+        due = self.incoming_due()
+        return due is not None and due <= time.time()
+
+    # Queue a stream delete ("delete", status_id) or edit ("update", status). Safe to call from any thread
+    def push_change(self, change, payload):
+        self.incoming_changes.append((change, payload))
+        wakeup.set()
+
+    # Called by the UI loop: adds lines printed from other threads, applies deletes and
+    # edits and, if they are due, formats up to max_results queued results
+    def process_incoming(self, max_results):
+        while len(self.incoming_prints) > 0:
+            x, right_side = self.incoming_prints.popleft()
+            self.print(x, right_side)
+
+        while len(self.incoming_changes) > 0:
+            change, payload = self.incoming_changes.popleft()
+            try:
+                if change == "delete":
+                    self.delete_status(payload)
+                else:
+                    self.update_status(payload)
+            except Exception as e:
+                self.print(theme["text"] + "Change -> " + str(e))
+
+        if not self.incoming_ready():
+            return
+
+        # Every result takes at least two lines, so results that newer ones in the queue
+        # would push out of the column right away aren't formatted at all
+        keep_results = max(self.max_lines // 2, 1)
+        while len(self.incoming_results) > keep_results:
+            self.incoming_results.popleft()
+            self.results_dropped += 1
+
+        batch = []
+        while len(batch) < max_results and len(self.incoming_results) > 0:
+            batch.append(self.incoming_results.popleft())
+
+        # The same status can arrive more than once in a batch, only show its latest version
+        last_seen = {}
+        for index, result in enumerate(batch):
+            if isinstance(result, dict) and "id" in result:
+                last_seen[result["id"]] = index
+
+        for index, result in enumerate(batch):
+            if isinstance(result, dict) and "id" in result and last_seen[result["id"]] != index:
+                self.results_coalesced += 1
+                continue
+            try:
+                self.add_result(result)
+            except Exception as e:
+                self.print(theme["text"] + "Result -> " + str(e))
+
     def print(self, x, right_side=None):
+        # Commands print from executor threads. Their lines are queued and added by
+        # the UI loop, so draw() never sees a column that is halfway through an update
+        if threading.get_ident() != ui_thread_id and event_loop is not None:
+            self.incoming_prints.append((x, right_side))
+            wakeup.set()
+            return
+
         if isinstance(x, Image.Image):
-            self.scrollback.append((x, None))
+            self.scrollback.append([x, None, None, None])
         elif isinstance(x, str):
-            new_lines = x.split("\n")
-            right_side_lines = [right_side] * len(new_lines)
-            self.scrollback.extend(zip(new_lines, right_side_lines))
-        if len(self.scrollback) > 3000:
-            self.scrollback = self.scrollback[len(self.scrollback)-3000:]
-            self.wrapped_cache = self.wrapped_cache[len(new_lines):]
+            pending_avatars = []
+            for line in x.split("\n"):
+                for avatar_url in AVATAR_MARKER_RE.findall(line):
+                    self.avatar_lines.setdefault(avatar_url, []).append(self.lines_dropped + len(self.scrollback))
+                    pending_avatars.append(avatar_url)
+                self.scrollback.append([line, right_side, None, None])
+            for avatar_url in pending_avatars:
+                avatar_resolver.wait_for(avatar_url, self)
+
+        # Drop the oldest lines, remembering how many wrapped lines they had
+        while len(self.scrollback) > self.max_lines:
+            dropped = self.scrollback.popleft()
+            self.lines_dropped += 1
+            if self.wrapped_count > 0:
+                self.wrapped_count -= 1
+                self.wrapped_base = dropped[3]
         self.dirty = True
         self.added = True
+        wakeup.set()
 
     def scroll(self, how_far):
         self.pos = self.pos + how_far
         self.dirty = True
+        wakeup.set()
+
+    # Called from the avatar fetch threads, lines get patched on the next draw
+    def avatar_ready(self, avatar_url):
+        self.avatars_ready.append(avatar_url)
+        self.dirty = True
+        wakeup.set()
+
+    def wrap_line(self, line, right_side, text_width):
+        if line is None:
+            return []
+        if isinstance(line, Image.Image):
+            return rendered_image_cache.render(line, text_width) + [""]
+        if "\n" in line:
+            return [wrapped for part in line.split("\n") for wrapped in self.wrap_line(part, None, text_width)]
+        line = resolve_avatar_markers(line)
+        if right_side is not None:
+            new_lines = align(line, right_side, text_width)
+        else:
+            new_lines = unserwrap.wrap(line, text_width)
+        if len(new_lines) == 0:
+            new_lines = [""]
+        return new_lines
+
+    def wrapped_len(self):
+        if self.wrapped_count == 0:
+            return 0
+        return self.scrollback[self.wrapped_count - 1][3] - self.wrapped_base
+
+    # Recompute running totals of wrapped lines from entry start on
+    def update_wrapped_ends(self, start):
+        line_end = self.scrollback[start - 1][3] if start > 0 else self.wrapped_base
+        for entry in self.scrollback.slice(start, self.wrapped_count):
+            line_end += len(entry[2])
+            entry[3] = line_end
+
+    # Wrapped lines start to end, found by binary search over the running totals
+    # without flattening the whole column
+    def get_wrapped(self, start, end):
+        low = 0
+        high = self.wrapped_count
+        while low < high:
+            mid = (low + high) // 2
+            if self.scrollback[mid][3] - self.wrapped_base <= start:
+                low = mid + 1
+            else:
+                high = mid
+        counter = low
+
+        wrapped_lines = []
+        if counter < self.wrapped_count:
+            entry_start = self.scrollback[counter - 1][3] if counter > 0 else self.wrapped_base
+            skip = start - (entry_start - self.wrapped_base)
+            while len(wrapped_lines) < end - start and counter < self.wrapped_count:
+                wrapped_lines.extend(self.scrollback[counter][2][skip:])
+                skip = 0
+                counter += 1
+        return wrapped_lines[:end - start]
 
     def draw(self, print_height, max_width):
         print_width = min(self.width, max_width - self.offset + 1)
         if print_width < 0:
+            # Off screen: nothing to draw, and a resize redraws everything anyway
+            self.dirty = False
+            self.full_redraw = False
             return
 
-        if self.full_redraw:
-            self.wrapped_cache = []
-            cursor_to(self.offset + 1, 1)
+        if self.full_redraw or self.dropped_shown != self.results_dropped:
+            title = self.title
+            if self.results_dropped > 0:
+                title += " (" + str(self.results_dropped) + " dropped)"
             if self.active:
-                sys.stdout.write(theme["active"] + self.title + " #")
+                screen.put(self.offset + 1, 1, theme["active"] + title + " #", print_width)
             else:
-                sys.stdout.write(theme["titles"] + self.title + "  ")
+                screen.put(self.offset + 1, 1, theme["titles"] + title + "  ", print_width)
+            self.dropped_shown = self.results_dropped
+
+        if self.full_redraw:
+            self.wrapped_count = 0
+            self.wrapped_base = 0
 
-            cursor_to(self.offset, 2)
             line_style = theme["lines"]
             if self.active:
                 line_style = theme["active"]
-            draw_line(line_style, print_width)
+            draw_line(self.offset, 2, line_style, print_width)
             self.full_redraw = False
             self.dirty = True
 
@@ -518,39 +1863,49 @@ class Scrollback:
         if text_width == 0:
             return
 
-        wrapped_lines = []
-        for counter, (line, right_side) in enumerate(self.scrollback):
-            if counter >= len(self.wrapped_cache):
-                if isinstance(line, str):
-                    if right_side is not None:
-                        new_lines = align(line, right_side, text_width)
-                    else:
-                        new_lines = unserwrap.wrap(line, text_width)
-                    if len(new_lines) == 0:
-                        new_lines = [""]
-                elif isinstance(line, Image.Image):
-                    new_lines = image_to_ansi_blocky(line, text_width) + [""]
-                wrapped_lines.extend(new_lines)
-                self.wrapped_cache.append(new_lines)
-            else:
-                wrapped_lines.extend(self.wrapped_cache[counter])
+        # Rewrap lines that were changed or whose avatars have arrived since the last draw
+        rewrap_serials = self.rewrap_serials
+        self.rewrap_serials = []
+        while len(self.avatars_ready) > 0:
+            avatar_url = self.avatars_ready.pop()
+            rewrap_serials.extend(self.avatar_lines.pop(avatar_url, []))
+        rewrap_from = self.wrapped_count
+        for line_serial in rewrap_serials:
+            line_index = line_serial - self.lines_dropped
+            if line_index >= 0 and line_index < self.wrapped_count:
+                entry = self.scrollback[line_index]
+                new_lines = self.wrap_line(entry[0], entry[1], text_width)
+                if len(new_lines) != len(entry[2]):
+                    rewrap_from = min(rewrap_from, line_index)
+                entry[2] = new_lines
+        self.update_wrapped_ends(rewrap_from)
+
+        # Wrap lines added since the last draw
+        new_count = len(self.scrollback) - self.wrapped_count
+        for entry in self.scrollback.slice(self.wrapped_count):
+            entry[2] = self.wrap_line(entry[0], entry[1], text_width)
+        self.wrapped_count += new_count
+        self.update_wrapped_ends(self.wrapped_count - new_count)
+        wrapped_len = self.wrapped_len()
 
         self.pos = max(self.pos, print_height)
-        self.pos = min(self.pos, len(wrapped_lines))
+        self.pos = min(self.pos, wrapped_len)
 
         if self.added:
-            self.pos = len(wrapped_lines)
+            self.pos = wrapped_len
         self.added = False
 
-        print_end = min(self.pos, len(wrapped_lines))
+        print_end = min(self.pos, wrapped_len)
         print_start = max(print_end - print_height, 0)
-        print_lines = wrapped_lines[print_start:print_end]
+        print_lines = self.get_wrapped(print_start, print_end)
 
         for line_pos, line in enumerate(print_lines):
-            cursor_to(self.offset, line_pos + 3)
-            clear_line(print_width + 1)
-            cursor_to(self.offset + 1, line_pos + 3)
-            sys.stdout.write(line)
+            screen.fill(self.offset, line_pos + 3, print_width + 1)
+            screen.put(self.offset + 1, line_pos + 3, line, text_width)
+
+        # The column can get shorter when results are removed
+        for line_pos in range(len(print_lines), print_height):
+            screen.fill(self.offset, line_pos + 3, print_width + 1)
 
 
 # Return app title, possibly animated
@@ -561,11 +1916,24 @@ def get_title():
         title_str += ansi_rgb(r, g, b) + character
     return title_str
 
+# True if screen_update_once() has something to draw
+def screen_needs_update():
+    if title_dirty or tuple(shutil.get_terminal_size()) != (last_cols, last_rows):
+        return True
+    for sc in buffers:
+        if sc.needs_redraw() or sc.incoming_ready():
+            return True
+    return False
+
 def screen_update_once():
     global title_dirty    
     global last_rows
     global last_cols
 
+    # Format queued results, a few per column per frame so a busy column can't hold up the others
+    for sc in buffers:
+        sc.process_incoming(max_results_per_frame)
+
     need_redraw = False
     for sc in buffers:
         if sc.needs_redraw():
@@ -578,6 +1946,7 @@ def screen_update_once():
     cols, rows = shutil.get_terminal_size()
     if rows != last_rows or cols != last_cols:
         sys.stdout.write(ansi_clear())
+        screen.resize(cols, rows)
         for sc in buffers:
             sc.full_redraw = True
         last_rows = rows
@@ -587,19 +1956,14 @@ def screen_update_once():
     if not need_redraw:
         return
 
-    cursor_save()
-    cursor_to(cols - len("tootmage") + 1, 0)
-    sys.stdout.write(get_title() + "")
+    screen.put(cols - len("tootmage") + 1, 1, get_title())
     print_height = rows - 4
     for sc in buffers:
         sc.draw(print_height, cols)
     draw_prompt_separator()
-    cursor_restore()
 
 def draw_prompt_separator():
-    cols, rows = shutil.get_terminal_size()
-    cursor_to(0, rows - 1)
-    draw_line(theme["lines"], cols)
+    draw_line(1, last_rows - 1, theme["lines"], last_cols)
 
 def move_cursor(new, xoff):
     cursor_to(new.x + xoff, new.y)
@@ -611,71 +1975,101 @@ class StoreTokens(Processor):
         cli_tokens = transformation_input.fragments
         return Transformation(transformation_input.fragments)
 
-def app_update(context):
+async def ui_loop():
     """
-    This function is used as an inputhook in the event loop.
-    It is called repeatedly while prompt_toolkit is idle,
-    so we can do background UI updates, watchers, etc.
+    Runs next to the prompt_toolkit application on the same event loop. It
+    redraws whatever is dirty (at most max_fps times a second), runs watchers
+    and then sleeps until wakeup.set() is called or the next watcher or
+    animation frame is due.
     """
-    if quitting:
-        return
-
     global title_offset
     global title_dirty
+    global last_frame_time
+    global prompt_dirty
     global watched
 
-    # We do a small idle loop: poll watchers, streams, etc.
-    while True:
-        # If there's typed input waiting, break so prompt_toolkit can proceed.
-        if context.input_is_ready():
-            break
-
-        # Animate the title if there's a command runner thread
-        thread_names = [t.name for t in threading.enumerate()]
-        if "command_runner" in thread_names:
-            title_offset += 2.0
-            title_dirty = True
+    while not quitting:
+        wakeup.clear()
+        now = time.time()
+        timeout = None
 
         # Run watchers
         for watched_expr in watched:
-            funct, last_exec, exec_every, scrollback = watched_expr
-            if time.time() - last_exec > exec_every:
-                watched_expr[1] = time.time()
-                eval_command_thread("", funct, scrollback, interactive=False)
-
-        # Check watchers for streams
-        for i in range(len(watched_streams)):
-            if not watched_streams[i][0].is_alive():
-                try:
-                    watched_streams[i][0].close()
-                except:
-                    pass
-                handle, function, collector = watched_streams[i]
-                new_stream = function(collector, run_async=True)
-                watched_streams[i] = (new_stream, function, collector)
-
-        # Redraw main UI
-        screen_update_once()
-
-        # Manually draw the CLI content
-        cols, rows = (last_cols, last_rows)
-        cursor_to(0, rows)
-        sys.stdout.write(theme["prompt"] + ">>> ")
-
-        # Render any “fragments” we captured:
-        for (style_str, text) in cli_tokens:
-            # look up a style or fallback
-            token_style = style_str if style_str in theme["prompt_toolkit_tokens"] else "Default"
-            if token_style not in theme["prompt_toolkit_tokens"]:
-                sys.stdout.write(theme["prompt"] + text)
-            else:
-                sys.stdout.write(theme["prompt_toolkit_tokens"][token_style] + text)
+            funct, last_exec, exec_every, scrollback, poller = watched_expr
+            if poller is not None:
+                exec_every = poller.interval
+            if now - last_exec > exec_every:
+                watched_expr[1] = now
+                # Skipped if the last run of this watcher hasn't finished yet
+                if poller is not None:
+                    job_manager.submit(poller.name, functools.partial(poller.poll, scrollback), key=id(watched_expr))
+                else:
+                    run_command("", funct, scrollback, interactive=False, key=id(watched_expr))
+            timeout = min_timeout(timeout, watched_expr[1] + exec_every - now)
+
+        # Wake up when queued results are due to be formatted
+        for sc in buffers:
+            due = sc.incoming_due()
+            if due is not None:
+                timeout = min_timeout(timeout, due - now)
+
+        # Animate the title while a command is running
+        animating = job_manager.in_flight(interactive_only=True) > 0
+
+        # Redraw, limited to max_fps. The prompt row is redrawn right away so typing doesn't lag
+        frame_due = last_frame_time + 1.0 / max_fps
+        if animating or prompt_dirty or screen_needs_update():
+            if now >= frame_due or (prompt_dirty and not animating):
+                if animating:
+                    title_offset += 2.0
+                    title_dirty = True
+                prompt_dirty = False
+                draw_frame()
+                last_frame_time = now
+                frame_due = now + 1.0 / max_fps
+            if animating or screen_needs_update():
+                timeout = min_timeout(timeout, frame_due - now)
+
+        # Sleep until something happens
+        await wakeup.wait(timeout)
+
+# prompt_toolkit just drew its own version of the prompt row, so paint ours over it
+def prompt_rendered(app):
+    global prompt_dirty
+    prompt_dirty = True
+    wakeup.set()
+
+# Shorter of two timeouts, where None means no timeout
+def min_timeout(timeout, other):
+    other = max(other, 0.0)
+    if timeout is None:
+        return other
+    return min(timeout, other)
+
+# Draw columns and prompt and send the changes to the terminal
+def draw_frame():
+    screen_update_once()
+
+    # Manually draw the CLI content
+    cols, rows = (last_cols, last_rows)
+    prompt = theme["prompt"] + ">>> "
+
+    # Render any “fragments” we captured:
+    for (style_str, text) in cli_tokens:
+        # look up a style or fallback
+        token_style = style_str if style_str in theme["prompt_toolkit_tokens"] else "Default"
+        if token_style not in theme["prompt_toolkit_tokens"]:
+            prompt += theme["prompt"] + text
+        else:
+            prompt += theme["prompt_toolkit_tokens"][token_style] + text
 
-        # Set cursor to correct position
-        cursor_to(get_app().layout.current_window.content.buffer.document.cursor_position_col + 5, rows)
-        sys.stdout.flush()        
+    # prompt_toolkit draws on the prompt row as well, so always send it again
+    screen.fill(1, rows, cols)
+    screen.put(1, rows, prompt)
+    screen.invalidate_row(rows)
 
-        time.sleep(0.01)
+    # Send changes and set cursor to correct position
+    screen.flush(get_app().layout.current_window.content.buffer.document.cursor_position_col + 5, rows)
 
 # Run a command and put the result in scrollback
 def eval_command(orig_command, command, scrollback, interactive=True, expand_using=None):
@@ -716,17 +2110,118 @@ def eval_command(orig_command, command, scrollback, interactive=True, expand_usi
     except Exception as e:
         scrollback.print(str(command) + " -> " + str(e))
 
-# Run a command, in a thread
-def eval_command_thread(orig_command, command, scrollback, interactive=True, expand_using=None):
-    thread_name = "command_runner"
-    if not interactive:
-        thread_name += "_bg"
-
-    def run():
-        eval_command(orig_command, command, scrollback, interactive, expand_using)
-
-    exec_thread = threading.Thread(target=run, daemon=True, name=thread_name)
-    exec_thread.start()
+# Background job, see JobManager
+class Job:
+    def __init__(self, job_id, name, interactive, key):
+        self.id = job_id
+        self.name = name
+        self.interactive = interactive
+        self.key = key
+        self.future = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+
+    # Seconds the job has been running (or waiting, if it hasn't started yet)
+    def duration(self):
+        end = self.finished if self.finished is not None else time.time()
+        start = self.started if self.started is not None else self.submitted
+        return end - start
+
+    def __repr__(self):
+        if self.finished is not None:
+            state = "cancelled" if self.cancelled else "done"
+        else:
+            state = "running" if self.started is not None else "waiting"
+        return "<Job {} {} {} {:.1f}s>".format(self.id, self.name, state, self.duration())
+
+# Job manager: commands, watchers and other blocking API calls run as jobs on
+# one fixed pool of worker threads. Jobs are tracked while in flight so the UI
+# can count them cheaply, and jobs submitted with a key are only run if no job
+# with the same key is still in flight.
+class JobManager:
+    def __init__(self, max_workers=4, keep_finished=50):
+        self.executor = DaemonThreadPool(max_workers, "job_runner")
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.keys = {}
+        self.next_id = 0
+        self.interactive_count = 0
+        self.finished = collections.deque(maxlen=keep_finished)
+
+    # Run function() on the pool. Returns the Job, or None if a job with this key is still in flight
+    def submit(self, name, function, interactive=False, key=None):
+        with self.lock:
+            if key is not None and key in self.keys:
+                return None
+            job = Job(self.next_id, name, interactive, key)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            if key is not None:
+                self.keys[key] = job
+            if interactive:
+                self.interactive_count += 1
+        job.future = self.executor.submit(self.run, job, function)
+        job.future.add_done_callback(lambda future: self.finish(job))
+        return job
+
+    def run(self, job, function):
+        job.started = time.time()
+        return function()
+
+    def finish(self, job):
+        with self.lock:
+            job.finished = time.time()
+            del self.jobs[job.id]
+            if job.key is not None:
+                del self.keys[job.key]
+            if job.interactive:
+                self.interactive_count -= 1
+            self.finished.append(job)
+        wakeup.set()
+
+    def in_flight(self, interactive_only=False):
+        if interactive_only:
+            return self.interactive_count
+        return len(self.jobs)
+
+    def running_jobs(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.id)
+
+    # Jobs that are still waiting are dropped. Running ones can't be interrupted, so
+    # they are only marked as cancelled and False is returned
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancelled = True
+        return job.future.cancel()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+# Run a command as a job, so slow API calls don't block the UI
+def run_command(orig_command, command, scrollback, interactive=True, expand_using=None, key=None):
+    name = orig_command
+    if callable(command):
+        name = getattr(command, "__name__", str(command))
+    job_manager.submit(name, functools.partial(eval_command, orig_command, command, scrollback, interactive, expand_using), interactive, key)
+
+# Run a blocking function (usually a Mastodon.py call) as a job and wait for it
+async def run_blocking(function, *args, **kwargs):
+    job = job_manager.submit(getattr(function, "__name__", str(function)), functools.partial(function, *args, **kwargs))
+    return await asyncio.wrap_future(job.future)
+
+# Run function on the event loop thread. From other threads it is queued, and
+# queued calls run in the order they were made.
+def call_in_ui(function, *args):
+    if event_loop is None or threading.get_ident() == ui_thread_id:
+        function(*args)
+    else:
+        event_loop.call_soon_threadsafe(function, *args)
 
 # Set up keybinds for prompt toolkit
 key_bindings = KeyBindings()
@@ -751,12 +2246,12 @@ def accept_line(event):
     if history is not None:
         history.append_string(text)
 
-    # Set the return value
-    event.app.exit(result=text)
+    run_input(text)
 
 @key_bindings.add("c-l")
 def clear_screen_key(event):
     sys.stdout.write(ansi_clear())
+    screen.invalidate()
     for sc in buffers:
         sc.full_redraw = True
 
@@ -790,19 +2285,106 @@ def prev_buffer_event(event):
     buffers[buffer_new].set_active(True)
     buffer_active = buffer_new
 
-def watch(function, scrollback, every_s):
-    watched.append([function, 0, every_s, scrollback])
+# Mastodon IDs are numbers (or numeric strings) of varying length, this sorts them numerically
+def id_sort_key(result_id):
+    result_id = str(result_id)
+    return (len(result_id), result_id)
+
+# Incremental polling for watch(): remembers the newest ID seen and only asks for
+# newer items (min_id), paging forward until caught up. While nothing new comes in,
+# the time between polls doubles, up to max_every_s.
+class IncrementalPoller:
+    def __init__(self, function, every_s, max_every_s=None, page_limit=40, max_pages=10):
+        self.function = function
+        self.name = getattr(function, "__name__", str(function))
+        self.every_s = every_s
+        self.interval = every_s
+        self.max_every_s = max_every_s if max_every_s is not None else every_s * 8
+        self.page_limit = page_limit
+        self.max_pages = max_pages
+        self.newest_id = None
+        self.calls = 0
+
+    # Remember an ID seen elsewhere (e.g. in a stream), later polls start after it
+    def saw(self, result_id):
+        if self.newest_id is None or id_sort_key(result_id) > id_sort_key(self.newest_id):
+            self.newest_id = result_id
+
+    # New results, oldest first
+    def fetch_new(self):
+        if self.newest_id is None:
+            self.calls += 1
+            results = list(self.function(limit=self.page_limit))
+        else:
+            results = []
+            min_id = self.newest_id
+            for page_num in range(self.max_pages):
+                self.calls += 1
+                page = self.function(min_id=min_id, limit=self.page_limit)
+                results.extend(page)
+                if len(page) < self.page_limit:
+                    break
+                min_id = max((result["id"] for result in page), key=id_sort_key)
+
+        results.sort(key=lambda result: id_sort_key(result["id"]))
+        if len(results) > 0:
+            self.newest_id = results[-1]["id"]
+        return results
+
+    def poll(self, scrollback):
+        try:
+            new_results = self.fetch_new()
+        except Exception as e:
+            scrollback.print(theme["text"] + self.name + " -> " + str(e))
+            self.interval = min(self.interval * 2, self.max_every_s)
+            return
 
+        # Skip anything the column already shows
+        new_results = [result for result in new_results if not scrollback.has_result(result)]
+        if len(new_results) > 0:
+            self.interval = self.every_s
+        else:
+            self.interval = min(self.interval * 2, self.max_every_s)
+        for result in new_results:
+            scrollback.push_result(result)
+
+# Run function every every_s seconds and print the result to scrollback. With incremental=True,
+# function must take min_id and limit (like m.timeline or m.notifications), and only new items are added
+def watch(function, scrollback, every_s, incremental=False):
+    poller = None
+    if incremental:
+        poller = IncrementalPoller(function, every_s)
+    watched.append([function, 0, every_s, scrollback, poller])
+    wakeup.set()
+
+# Stream listener. Mastodon.py calls it from its stream threads, events are
+# queued on their column with push_result.
 class EventCollector(StreamListener):
     def __init__(self, event_handler=None, notification_event_handler=None):
         super(EventCollector, self).__init__()
         self.event_handler = event_handler
         self.notification_event_handler = notification_event_handler
+        self.aborted = asyncio.Event()
+        self.error = None
 
     def on_update(self, status):
         if self.event_handler is not None:
             self.event_handler(status)
 
+    # Deletes and edits are applied to every column, wherever the status shows up
+    def on_delete(self, status_id):
+        for sc in buffers:
+            sc.push_change("delete", status_id)
+
+    def on_status_update(self, status):
+        for sc in buffers:
+            sc.push_change("update", status)
+
+    def on_abort(self, err):
+        # Stream died, wake up its StreamSupervisor so it gets restarted
+        self.error = err
+        event_loop.call_soon_threadsafe(self.aborted.set)
+
     def on_notification(self, notification):
         # Pop up notification
         user = "@" + notification.account.acct
@@ -824,31 +2406,137 @@ class EventCollector(StreamListener):
         if self.notification_event_handler is not None:
             self.notification_event_handler(notification)
 
+# Keeps one stream running: fills its columns, restarts the stream when it dies
+# (with jittered exponential backoff) and afterwards backfills whatever was posted
+# while it was down, through the REST calls used for the initial fill.
+class StreamSupervisor:
+    def __init__(self, function, scrollback=None, scrollback_notifications=None,
+                 initial_fill=None, initial_fill_notifications=None,
+                 min_backoff_s=1.0, max_backoff_s=300.0, stable_s=60.0, check_every_s=5.0):
+        self.function = function
+        self.name = getattr(function, "__name__", str(function))
+        self.scrollback = scrollback
+        self.scrollback_notifications = scrollback_notifications
+        self.min_backoff_s = min_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.stable_s = stable_s
+        self.check_every_s = check_every_s
+
+        # Pollers remember the newest ID seen, which is where backfilling starts
+        self.status_poller = None
+        if scrollback is not None and initial_fill is not None:
+            self.status_poller = IncrementalPoller(initial_fill, 0, page_limit=20)
+        self.notification_poller = None
+        if scrollback_notifications is not None and initial_fill_notifications is not None:
+            self.notification_poller = IncrementalPoller(initial_fill_notifications, 0, page_limit=20)
+
+        self.collector = None
+        self.handle = None
+        self.closed = False
+        self.failures = 0
+        self.reconnects = 0
+        self.downtime_s = 0.0
+        self.down_since = None
+        self.connected_since = None
+        self.last_error = None
+
+    def on_status(self, status):
+        if self.status_poller is not None:
+            self.status_poller.saw(status["id"])
+        self.scrollback.push_result(status)
+
+    def on_notification(self, notification):
+        if self.notification_poller is not None:
+            self.notification_poller.saw(notification["id"])
+        self.scrollback_notifications.push_result(notification)
+
+    async def backfill(self):
+        if self.status_poller is not None:
+            await run_blocking(self.status_poller.poll, self.scrollback)
+        if self.notification_poller is not None:
+            await run_blocking(self.notification_poller.poll, self.scrollback_notifications)
+
+    def backoff_s(self):
+        # The exponent is capped so long outages don't overflow the float
+        backoff = min(self.max_backoff_s, self.min_backoff_s * 2 ** min(self.failures - 1, 32))
+        return backoff * random.uniform(0.5, 1.0)
+
+    async def run(self):
+        event_handler = self.on_status if self.scrollback is not None else None
+        notification_event_handler = self.on_notification if self.scrollback_notifications is not None else None
+        self.collector = EventCollector(event_handler, notification_event_handler)
+
+        await self.backfill()
+        while not self.closed and not quitting:
+            try:
+                self.handle = await run_blocking(self.function, self.collector, run_async=True)
+            except Exception as e:
+                self.handle = None
+                self.last_error = e
+
+            if self.handle is not None:
+                if self.down_since is not None:
+                    self.downtime_s += time.time() - self.down_since
+                    self.down_since = None
+                    await self.backfill()
+                self.connected_since = time.time()
+                await self.wait_while_alive()
+                if time.time() - self.connected_since >= self.stable_s:
+                    self.failures = 0
+                self.connected_since = None
+                if self.collector.error is not None:
+                    self.last_error = self.collector.error
+                    self.collector.error = None
+                try:
+                    self.handle.close()
+                except:
+                    pass
+
+            if self.closed or quitting:
+                break
+            if self.down_since is None:
+                self.down_since = time.time()
+            self.failures += 1
+            self.reconnects += 1
+            await asyncio.sleep(self.backoff_s())
+
+    # Streams tell us when they abort, but look now and then anyway
+    async def wait_while_alive(self):
+        while not self.closed and not quitting and self.handle.is_alive():
+            try:
+                await asyncio.wait_for(self.collector.aborted.wait(), self.check_every_s)
+            except asyncio.TimeoutError:
+                pass
+            self.collector.aborted.clear()
+
+    def close(self):
+        self.closed = True
+        if self.handle is not None:
+            try:
+                self.handle.close()
+            except:
+                pass
+
+    # Seconds the stream has been down in total, including right now
+    def total_downtime_s(self):
+        if self.down_since is None:
+            return self.downtime_s
+        return self.downtime_s + time.time() - self.down_since
+
+    def __repr__(self):
+        state = "connected" if self.connected_since is not None else "down"
+        return "<StreamSupervisor {} {}, {} reconnects, {:.1f}s down>".format(self.name, state, self.reconnects, self.total_downtime_s())
+
 def watch_stream(function, scrollback=None, scrollback_notifications=None,
                  initial_fill=None, initial_fill_notifications=None):
-    def watch_stream_internal():
-        event_handler = None
-        if scrollback is not None:
-            event_handler = scrollback.add_result
-            if initial_fill is not None:
-                initial_data = initial_fill()
-                for result in reversed(initial_data):
-                    event_handler(result)
-
-        notification_event_handler = None
-        if scrollback_notifications is not None:
-            notification_event_handler = scrollback_notifications.add_result
-            if initial_fill_notifications is not None:
-                initial_data_notif = initial_fill_notifications()
-                for result in reversed(initial_data_notif):
-                    notification_event_handler(result)
-
-        collector = EventCollector(event_handler, notification_event_handler)
-        handle = function(collector, run_async=True)
-        watched_streams.append((handle, function, collector))
-
-    watch_start_thread = threading.Thread(target=watch_stream_internal, daemon=True, name="start_watch")
-    watch_start_thread.start()
+    supervisor = StreamSupervisor(function, scrollback, scrollback_notifications, initial_fill, initial_fill_notifications)
+    watched_streams.append(supervisor)
+    if event_loop is None:
+        # Called from settings, started once the event loop runs
+        pending_streams.append(supervisor)
+    else:
+        call_in_ui(lambda: event_loop.create_task(supervisor.run()))
+    return supervisor
 
 class MastodonFuncCompleter(Completer):
     """
@@ -962,6 +2650,16 @@ class MastodonFuncCompleter(Completer):
         for match in good_matches:
             yield match
 
+# Defaults for everything settings.py sets up, so older settings files keep working
+media_fetcher = MediaFetcher(max_bytes = 16 * 1024 * 1024, connect_timeout_s = 5, read_timeout_s = 20)
+image_cache = ImageCache("tootmage_images.cache", max_disk_bytes = 256 * 1024 * 1024, max_images = 64)
+image_backend = select_image_backend("auto")
+rendered_image_cache = RenderedImageCache(max_bytes = 32 * 1024 * 1024)
+status_render_cache = StatusRenderCache(max_entries = 2000)
+avatar_cache = AvatarCache("tootmage_avatars.cache", max_entries = 5000, ttl_s = 7 * 24 * 60 * 60)
+avatar_resolver = AvatarResolver(max_workers = 4)
+job_manager = JobManager(max_workers = 4)
+
 # Read settings
 exec(open("./settings.py", 'rb').read().decode("utf-8"))
 
@@ -1009,130 +2707,122 @@ def create_bottom_repl_application(completer = None,  history = None,):
         erase_when_done = True,
         cursor = CursorShape.BLOCK,
     )
-    set_eventloop_with_inputhook(app_update)
+    app.after_render += prompt_rendered
     return app
 
-# Example run_app function:
-def run_app():
-    global history
-    history = FileHistory(".tootmage_history")
-    completer = MastodonFuncCompleter(m)
-
-    app = create_bottom_repl_application(
-        completer = completer,
-        history = history
-    )
-    
-    while True:
-        # The app.run() will block until user hits Enter or we exit.
-        user_input = app.run()
-
-        # user_input is what they typed.
-        orig_command = user_input
-        command = user_input
+# Run a line typed at the prompt
+def run_input(user_input):
+    global quitting
 
-        if len(command.strip()) == 0:
-            continue
+    # user_input is what they typed.
+    orig_command = user_input
+    command = user_input
 
-        if command[0] == ";":
-            command = command[1:]
-            py_direct = True
-            expand_using = None
-        else:
-            py_direct = False
-            expand_using = None
+    if len(command.strip()) == 0:
+        return
 
-        command = orig_command
-        
-        if len(command.strip()) == 0:
-            continue
-        
-        # Starts with semicolon -> python command
+    if command[0] == ";":
+        command = command[1:]
+        py_direct = True
+        expand_using = None
+    else:
         py_direct = False
         expand_using = None
-        if command[0] == ";":
-            command = command[1:]
-            py_direct = True
+
+    command = orig_command
+    
+    if len(command.strip()) == 0:
+        return
+    
+    # Starts with semicolon -> python command
+    py_direct = False
+    expand_using = None
+    if command[0] == ";":
+        command = command[1:]
+        py_direct = True
+    else:
+        # Starts with # or . -> buffer ref
+        if command[0] in "#.":
+            pass
         else:
-            # Starts with # or . -> buffer ref
-            if command[0] in "#.":
-                pass
-            else:
-                # Direct command -> autocomplete
-                command_parts = command.split(" ")
-                potential_commands = list(MastodonFuncCompleter(m).get_completions(
-                    Document(command_parts[0]),
-                    CompleteEvent(False, True)
-                ))
-                if len(potential_commands) > 0:
-                    command_parts[0] = potential_commands[0].text
-                
-                # Dotify command part if unambiguously needed
-                if command_parts[0].startswith("status_"):
-                    if len(command_parts) >= 2 and not (command_parts[1].startswith(".") or command_parts[1].startswith("#")):
-                        command_parts[1] = "." + command_parts[1]
+            # Direct command -> autocomplete
+            command_parts = command.split(" ")
+            potential_commands = list(MastodonFuncCompleter(m).get_completions(
+                Document(command_parts[0]),
+                CompleteEvent(False, True)
+            ))
+            if len(potential_commands) > 0:
+                command_parts[0] = potential_commands[0].text
+            
+            # Dotify command part if unambiguously needed
+            if command_parts[0].startswith("status_"):
+                if len(command_parts) >= 2 and not (command_parts[1].startswith(".") or command_parts[1].startswith("#")):
+                    command_parts[1] = "." + command_parts[1]
+            
+            # Special handling for boost, reply, expand commands
+            if command_parts[0] == "status_reply" and len(command_parts) >= 2:
+                command_parts_new = []
+                command_parts_new.append("status_post")
                 
-                # Special handling for boost, reply, expand commands
-                if command_parts[0] == "status_reply" and len(command_parts) >= 2:
-                    command_parts_new = []
-                    command_parts_new.append("status_post")
-                    
-                    in_reply_to = command_parts[1]
-                    in_reply_to = re.sub(r'#([0-9]+)', r'buffers[' + str(buffer_active) + r'].result_history[\1]', in_reply_to)
-                    in_reply_to = re.sub(r'#', r'buffers[' + str(buffer_active) + '].result_history', in_reply_to)
-                    in_reply_to = re.sub(r'\.([0-9]+)\.([0-9]+)', r'buffers[\1].result_history[\2]', in_reply_to)
-                    
-                    try:
-                        in_reply_to_obj = eval(in_reply_to)
-                        if "mentions" not in in_reply_to_obj:
-                            command_parts[1] = command_parts[1] + ".status"
-                    except:
-                        pass
-                    
-                    toot_text = " ".join(command_parts[2:])
-                    toot_text = toot_text.replace("\"", "\\\"")
-                    toot_text = "\"" + toot_text + "\""
-                    toot_text = '"".join(map(lambda x: ("@" + x.acct + " ") if x.acct != m._acct else "", [' + \
-                        command_parts[1] + '.account] + ' + command_parts[1] + '.mentions)) + ' + toot_text
-                    command_parts_new.append(toot_text)
-                    
-                    command_parts_new.append(", in_reply_to_id=" + command_parts[1])
-                    command_parts_new.append(", sensitive=" + command_parts[1] + ".sensitive")
-                    command_parts_new.append(", spoiler_text=" + command_parts[1] + ".spoiler_text")
-                    
-                    command_parts = command_parts_new
+                in_reply_to = command_parts[1]
+                in_reply_to = re.sub(r'#([0-9]+)', r'buffers[' + str(buffer_active) + r'].result_history[\1]', in_reply_to)
+                in_reply_to = re.sub(r'#', r'buffers[' + str(buffer_active) + '].result_history', in_reply_to)
+                in_reply_to = re.sub(r'\.([0-9]+)\.([0-9]+)', r'buffers[\1].result_history[\2]', in_reply_to)
                 
-                if command_parts[0] == "status_boost":
-                    command_parts[0] = "status_reblog"
+                try:
+                    in_reply_to_obj = eval(in_reply_to)
+                    if "mentions" not in in_reply_to_obj:
+                        command_parts[1] = command_parts[1] + ".status"
+                except:
+                    pass
                 
-                if command_parts[0] == "status_expand":
-                    command_parts = [command_parts[1]]
-                    expand_using = m
+                toot_text = " ".join(command_parts[2:])
+                toot_text = toot_text.replace("\"", "\\\"")
+                toot_text = "\"" + toot_text + "\""
+                toot_text = '"".join(map(lambda x: ("@" + x.acct + " ") if x.acct != m._acct else "", [' + \
+                    command_parts[1] + '.account] + ' + command_parts[1] + '.mentions)) + ' + toot_text
+                command_parts_new.append(toot_text)
                 
-                if command_parts[0] == "toot":
-                    toot_text = " ".join(command_parts[1:])
-                    toot_text = toot_text.replace("\"", "\\\"")
-                    toot_text = "\"" + toot_text + "\""
-                    command_parts = [command_parts[0], toot_text]
-                    
-                if command_parts[0] == "status_view":
-                    if len(command_parts) <= 2:
-                        url_str = command_parts[1] + ".reblog.url if ('reblog' in " + command_parts[1] + " and " + command_parts[1] + ".reblog != None) else (" + \
-                            command_parts[1] + ".status.url if 'status' in " + command_parts[1] + " else " + \
-                            command_parts[1] + ".url)"
-                    else:
-                        url_str = command_parts[1] + '["__urls"][' +  command_parts[2] + ']'
-                    command = "view_command(" + url_str + ")"
-                    py_direct = True
+                command_parts_new.append(", in_reply_to_id=" + command_parts[1])
+                command_parts_new.append(", sensitive=" + command_parts[1] + ".sensitive")
+                command_parts_new.append(", spoiler_text=" + command_parts[1] + ".spoiler_text")
                 
-                if command_parts[0] == "quit":
-                    print("Quitting...")
-                    for thread in watched_streams:
-                        thread[0].close()
-                    sys.exit(0)
+                command_parts = command_parts_new
+            
+            if command_parts[0] == "status_boost":
+                command_parts[0] = "status_reblog"
+            
+            if command_parts[0] == "status_expand":
+                command_parts = [command_parts[1]]
+                expand_using = m
+            
+            if command_parts[0] == "toot":
+                toot_text = " ".join(command_parts[1:])
+                toot_text = toot_text.replace("\"", "\\\"")
+                toot_text = "\"" + toot_text + "\""
+                command_parts = [command_parts[0], toot_text]
                 
-                if command_parts[0] == "help":
-                    help_text = """Base commands:
+            if command_parts[0] == "status_view":
+                if len(command_parts) <= 2:
+                    url_str = command_parts[1] + ".reblog.url if ('reblog' in " + command_parts[1] + " and " + command_parts[1] + ".reblog != None) else (" + \
+                        command_parts[1] + ".status.url if 'status' in " + command_parts[1] + " else " + \
+                        command_parts[1] + ".url)"
+                else:
+                    url_str = command_parts[1] + '["__urls"][' +  command_parts[2] + ']'
+                command = "view_command(" + url_str + ")"
+                py_direct = True
+            
+            if command_parts[0] == "quit":
+                print("Quitting...")
+                quitting = True
+                for supervisor in watched_streams:
+                    supervisor.close()
+                avatar_cache.save()
+                get_app().exit()
+                return
+            
+            if command_parts[0] == "help":
+                help_text = """Base commands:
     status_view <status> [<url_num>] - View status or URL or attachment in browser. Alias: v
     status_expand <status> - Expand conversation. Alias: x
     status_boost <status> - Boost status: Alias: b
@@ -1159,26 +2849,193 @@ Advanced commands:
     <any Mastodon.py function> - Execute Mastodon.py function
     ;<python code> - Execute python code directly
 """
-                    for line in help_text.split("\n"):
-                        buffers[-1].print(theme["text"] + line)
-                    continue
+                for line in help_text.split("\n"):
+                    buffers[-1].print(theme["text"] + line)
+                return
 
-                # Build actual command
-                if  py_direct == False:
-                    if expand_using == None:
-                        command = command_parts[0] + "(" + " ".join(command_parts[1:]) + ")"
-                        command = "m." + command
-                    else:
-                        command = command_parts[0]
-                    
-        command = re.sub(r'#([0-9]+)', r'buffers[' + str(buffer_active) + r'].result_history[\1]', command)
-        command = re.sub(r'#', r'buffers[' + str(buffer_active) + '].result_history', command)
-        command = re.sub(r'\.([0-9]+)\.([0-9]+)', r'buffers[\1].result_history[\2]', command)
-        
-        if command.find("=") == -1 or not py_direct:
-            command = "__thread_res = (" + command + ")"
-        
-        eval_command_thread(orig_command, command, buffers[-1], expand_using = expand_using)
+            # Build actual command
+            if  py_direct == False:
+                if expand_using == None:
+                    command = command_parts[0] + "(" + " ".join(command_parts[1:]) + ")"
+                    command = "m." + command
+                else:
+                    command = command_parts[0]
+                
+    command = re.sub(r'#([0-9]+)', r'buffers[' + str(buffer_active) + r'].result_history[\1]', command)
+    command = re.sub(r'#', r'buffers[' + str(buffer_active) + '].result_history', command)
+    command = re.sub(r'\.([0-9]+)\.([0-9]+)', r'buffers[\1].result_history[\2]', command)
+    
+    if command.find("=") == -1 or not py_direct:
+        command = "__thread_res = (" + command + ")"
+    
+    run_command(orig_command, command, buffers[-1], expand_using = expand_using)
+
+# Runs the prompt and the UI loop on one asyncio event loop until quit
+async def run_app_async():
+    global history
+    global event_loop
+    global ui_thread_id
+    wakeup.attach()
+    event_loop = asyncio.get_running_loop()
+    ui_thread_id = threading.get_ident()
+
+    history = FileHistory(".tootmage_history")
+    completer = MastodonFuncCompleter(m)
+
+    app = create_bottom_repl_application(
+        completer = completer,
+        history = history
+    )
+
+    def start_tasks():
+        app.create_background_task(ui_loop())
+        for supervisor in pending_streams:
+            app.create_background_task(supervisor.run())
+        pending_streams.clear()
+
+    try:
+        await app.run_async(pre_run = start_tasks)
+    finally:
+        job_manager.shutdown()
+
+def run_app():
+    asyncio.run(run_app_async())
 
 if __name__ == "__main__":
     run_app()
+
+"""
+# Benchmarking
+
+# parse_toot_html against the old chain of regex substitutions in clean_text and the URL
+# regex plus str.replace per URL in number_urls, on typical toot HTML
+import timeit
+
+def clean_text_regex(text, style_names, style_text):
+    content_clean = re.sub(r'<a [^>]*href="([^"]+)">[^<]*</a>', r'\1', text)
+    content_clean = content_clean.replace('<span class="h-card">', style_names)
+    content_clean = content_clean.replace('</span><span class="ellipsis">', "")
+    content_clean = content_clean.replace('</span><span class="invisible">', "")
+    content_clean = re.sub(r'</span><span class="[^"]*">', '', content_clean)
+    content_clean = content_clean.replace('</span>', style_text)
+    content_clean = content_clean.replace("</p>", "\n")
+    content_clean = re.sub(r"<br[^>]*>", "\n", content_clean)
+    content_clean = html.unescape(str(re.compile(r'<.*?>').sub("", content_clean).strip()))
+
+    content_split = []
+    for line in content_clean.split("\n"):
+        content_split.append(style_text + line)
+    return "\n".join(content_split)
+
+def number_urls_regex(text, style_url_nums, style_text):
+    urls = re.findall(
+        r'http[s]?://(?:[a-zA-Z0-9$-_@.&+!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
+        text
+    )
+    url_num = 0
+    replaced_urls = []
+    for url in urls:
+        if url not in replaced_urls:
+            text = text.replace(url, style_url_nums + "(" + str(url_num) + ")" + style_text + " " + url)
+            replaced_urls.append(url)
+            url_num += 1
+    return text, replaced_urls
+
+def content_regex(toot):
+    return number_urls_regex(clean_text_regex(toot, "\033[1m", "\033[0m"), "\033[2m", "\033[0m")
+
+def content_parsed(toot):
+    return parse_toot_html(toot, "\033[1m", "\033[0m", "\033[2m")[:2]
+
+toot_corpus = [
+    '<p>Just released version 2.0! Changelog: <a href="https://github.com/example/tootmage/releases/tag/v2.0" target="_blank" rel="nofollow noopener noreferrer" translate="no"><span class="invisible">https://</span><span class="ellipsis">github.com/example/tootmage/re</span><span class="invisible">leases/tag/v2.0</span></a></p><p>Thanks <span class="h-card" translate="no"><a href="https://mastodon.social/@alice" class="u-url mention">@<span>alice</span></a></span> for testing! <a href="https://mastodon.social/tags/python" class="mention hashtag" rel="tag">#<span>python</span></a></p>',
+    '<p><span class="h-card"><a href="https://botsin.space/@halcy" class="u-url mention">@<span>halcy</span></a></span> that&#39;s great &amp; all, but what about &lt;tags&gt;?</p>',
+    '<p>Line one<br />Line two<br />Line three</p><p>New paragraph with an emoji 🎉 and some 日本語のテキスト too.</p>',
+    '<p>RE: <a href="https://fosstodon.org/@carol/112233445566778899" target="_blank" rel="nofollow noopener noreferrer" translate="no"><span class="invisible">https://</span><span class="ellipsis">fosstodon.org/@carol/112233445</span><span class="invisible">566778899</span></a></p><p>Agreed, this is the way.</p>',
+    '<p>Short one.</p>',
+    '<p>Docs at <a href="https://example.org/docs" rel="nofollow noopener noreferrer" target="_blank">https://example.org/docs</a>, API at <a href="https://example.org/docs/api" rel="nofollow noopener noreferrer" target="_blank">https://example.org/docs/api</a>, again <a href="https://example.org/docs" rel="nofollow noopener noreferrer" target="_blank">https://example.org/docs</a></p>',
+    '<p>' + 'A long toot with lots of words. ' * 30 + '</p><p>' + 'Second paragraph continues. ' * 20 + '</p>',
+]
+
+for function in [content_regex, content_parsed]:
+    times = timeit.repeat(lambda: [function(toot) for toot in toot_corpus], number=1000, repeat=5)
+    print(function.__name__, round(min(times) / 1000 / len(toot_corpus) * 1000000, 2), "us per toot")
+
+# avatar_image_cols against the old per-pixel loop, on a fixed set of generated images and the
+# theme screenshots. The colours should be exactly the same.
+def avatar_image_cols_reference(avatar_image):
+    avatar_image = avatar_image.resize((AVATAR_SIZE, AVATAR_SIZE))
+    avatar_image = avatar_image.convert('RGBA').convert('RGB').convert('HSV')
+    avatar = avatar_image.load()
+
+    hue_bins = list(map(lambda x: [], range(1 + 255 // 10)))
+    hue_weights = [0.0] * (1 + 255 // 10)
+    center_x = avatar_image.size[0] / 2
+    center_y = avatar_image.size[1] / 2
+    for y in range(avatar_image.size[1]):
+        for x in range(avatar_image.size[0]):
+            x_dev = (x - center_x) / avatar_image.size[0]
+            y_dev = (y - center_y) / avatar_image.size[1]
+            center_dist = math.sqrt(math.pow(x_dev, 2.0) + math.pow(y_dev, 2.0))
+            col = avatar[x, y]
+            hue_bin = col[0] // 10
+            hue_bins[hue_bin].append(col)
+            hue_weights[hue_bin] += 0.5 + (col[1] / 255.0) * 0.5 + center_dist * 0.1 + abs(col[2] / 255.0 - 0.5) * 0.25
+
+    hues_sorted = [x for _, x in sorted(zip(hue_weights, hue_bins))]
+    primary_cols = []
+    all_most_common_cols = []
+    for hue in reversed(hues_sorted[-4:]):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            try:
+                most_common_cols = list(reversed(sorted(set(hue), key=hue.count)))
+                all_most_common_cols = most_common_cols + all_most_common_cols
+                found_col = False
+                for test_col in np.array(all_most_common_cols):
+                    worst_difference = 100.0
+                    if len(primary_cols) > 0:
+                        for col in primary_cols:
+                            worst_difference = min(
+                                np.linalg.norm(col - np.array(colorsys.hsv_to_rgb(*test_col / 255.0))),
+                                worst_difference
+                            )
+                    if worst_difference > 0.2:
+                        found_col = True
+                        primary_cols.append(list(np.array(colorsys.hsv_to_rgb(*(test_col / 255.0)))))
+                        break
+                if not found_col:
+                    median_col = np.median(hue, axis=0)
+                    primary_cols.append(list(np.array(colorsys.hsv_to_rgb(*(median_col / 255.0)))))
+            except:
+                primary_cols.append(primary_cols[0])
+    return primary_cols
+
+rng = np.random.default_rng(1)
+avatar_images = [
+    Image.new("RGB", (64, 64), (40, 120, 200)),
+    Image.new("RGB", (64, 64), (128, 128, 128)),
+    Image.new("RGBA", (64, 64), (255, 0, 0, 0)),
+    Image.fromarray(np.tile(np.arange(256, dtype=np.uint8)[:, np.newaxis, np.newaxis], (1, 256, 3))),
+    Image.fromarray(np.kron((np.indices((8, 8)).sum(axis=0) % 2 * 255).astype(np.uint8), np.ones((8, 8), dtype=np.uint8))).convert("RGB"),
+]
+for palette_size in [2, 3, 5, 8, 16, 256]:
+    palette = rng.integers(0, 256, (palette_size, 3), dtype=np.uint8)
+    for size in [48, 60, 400]:
+        avatar_images.append(Image.fromarray(palette[rng.integers(0, palette_size, (size, size))]))
+for size in [60, 200]:
+    avatar_images.append(Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)))
+    avatar_images.append(Image.fromarray(rng.integers(0, 256, (size, size, 4), dtype=np.uint8), "RGBA"))
+for theme_png in ["datawitch.png", "helvetica_standard.png"]:
+    avatar_images.append(Image.open(theme_png))
+
+mismatches = 0
+for avatar_image in avatar_images:
+    if not np.array_equal(np.array(avatar_image_cols(avatar_image)), np.array(avatar_image_cols_reference(avatar_image))):
+        mismatches += 1
+print(mismatches, "of", len(avatar_images), "images differ, should be 0")
+
+for function in [avatar_image_cols_reference, avatar_image_cols]:
+    times = timeit.repeat(lambda: [function(avatar_image) for avatar_image in avatar_images], number=1, repeat=3)
+    print(function.__name__, round(min(times) / len(avatar_images) * 1000, 2), "ms per avatar")
+"""
@@ -14,20 +14,53 @@ with open("tootmage_url.secret", "r") as f:
 m = Mastodon(client_id = 'tootmage_client.secret', access_token = 'tootmage_user.secret', api_base_url = MASTODON_BASE_URL)
 m._acct = m.account_verify_credentials()["acct"]
 
-# Set up columns
+# All avatar and image downloads share one connection pool. Downloads larger than max_bytes are refused
+media_fetcher = MediaFetcher(max_bytes = 16 * 1024 * 1024, connect_timeout_s = 5, read_timeout_s = 20)
+
+# Images viewed inline are cached on disk (up to max_disk_bytes) and the last few in memory
+image_cache = ImageCache("tootmage_images.cache", max_disk_bytes = 256 * 1024 * 1024, max_images = 64)
+
+# How to show images: "auto" picks based on the terminal, or set "halfblock", "sixel" or "kitty"
+image_backend = select_image_backend("auto")
+
+# Images rendered for display are kept for redraws, up to max_bytes
+rendered_image_cache = RenderedImageCache(max_bytes = 32 * 1024 * 1024)
+
+# Formatted statuses are kept too, so a status showing up in several columns is only formatted once
+status_render_cache = StatusRenderCache(max_entries = 2000)
+
+# Avatar colours are cached on disk, so only new accounts need their avatar downloaded
+avatar_cache = AvatarCache("tootmage_avatars.cache", max_entries = 5000, ttl_s = 7 * 24 * 60 * 60)
+
+# Avatars that aren't cached yet are downloaded in the background, this many at a time
+avatar_resolver = AvatarResolver(max_workers = 4)
+
+# Commands, watchers and other API calls run in the background, this many at a time
+job_manager = JobManager(max_workers = 4)
+
+# The screen is redrawn at most this many times per second
+max_fps = 30
+
+# New toots from streams are collected for batch_window_s seconds and then formatted together, at most
+# max_results_per_frame per column and frame, so a busy column can't hold up the rest
+max_results_per_frame = 20
+batch_window_s = 0.25
+
+# Set up columns. max_lines is how many lines each column keeps before dropping the oldest ones
 buffers = [
-    Scrollback("0: home", 0, 50),
-    Scrollback("1: notifications", 51, 50),
-    Scrollback("2: local", 102, 50),
-    Scrollback("3: scratch", 153, 5000),
+    Scrollback("0: home", 0, 50, max_lines = 3000),
+    Scrollback("1: notifications", 51, 50, max_lines = 3000),
+    Scrollback("2: local", 102, 50, max_lines = 3000),
+    Scrollback("3: scratch", 153, 5000, max_lines = 3000),
 ]
 buffer_active = len(buffers) - 1
 buffers[buffer_active].set_active(True)
 
 # Set up column contents, either via watching a function every X seconds, or by watching a stream
-#watch(m.timeline, buffers[0]], 60)
-#watch(m.notifications, buffers[1], 60)
-#watch(m.timeline_local, buffers[2], 60)
+# incremental = True only fetches what's new since the last poll, and polls less often while nothing is
+#watch(m.timeline, buffers[0], 60, incremental = True)
+#watch(m.notifications, buffers[1], 60, incremental = True)
+#watch(m.timeline_local, buffers[2], 60, incremental = True)
 watch_stream(m.stream_user, buffers[0], buffers[1], m.timeline, m.notifications)
 watch_stream(m.stream_local, buffers[2], initial_fill = m.timeline_local)
 
@@ -7,6 +7,7 @@
 # Inlcuded here so we can patch the len function
 
 import re
+import functools
 
 __all__ = ['TextWrapper', 'wrap', 'fill', 'dedent', 'indent', 'shorten']
 
@@ -20,10 +21,103 @@ from .ansistate import ANSIState
 
 ANSIRE = re.compile('\x1b\\[(K|.*?m)')
 
+# Widths of single characters, filled in as they are seen
+_char_widths = {}
+
+def char_width_unicode(c):
+    width = _char_widths.get(c)
+    if width is None:
+        width = wcwidth.wcwidth(c)
+        _char_widths[c] = width
+    return width
+
+# Same as wcwidth.wcswidth of the NFC normalized string without escapes (newlines
+# count as one column), but from the per-character table where possible
+@functools.lru_cache(maxsize=4096)
+def _ansilen_unicode_cached(s):
+    if "\x1b" in s:
+        s = ANSIRE.sub('', s)
+    if not s.isascii() and not unicodedata.is_normalized('NFC', s):
+        s = unicodedata.normalize('NFC', s)
+    s = s.replace("\n", "_")
+    if s.isascii() and s.isprintable():
+        return len(s)
+
+    # Zero width joiners and variation selectors change the width of the characters next to them
+    if "\u200d" in s or "\ufe0f" in s:
+        return wcwidth.wcswidth(s)
+
+    # Printable text has no control characters (the only ones wcwidth says are -1 wide),
+    # so if all characters are in the table, their widths can just be added up
+    if s.isprintable():
+        try:
+            return sum(map(_char_widths.__getitem__, s))
+        except KeyError:
+            pass
+
+    width = 0
+    for c in s:
+        c_width = _char_widths.get(c)
+        if c_width is None:
+            c_width = char_width_unicode(c)
+        if c_width < 0:
+            return c_width
+        width += c_width
+    return width
+
 def ansilen_unicode(s):
-    s_without_ansi = unicodedata.normalize('NFC', ANSIRE.sub('', s))
-    s_without_ansi = s_without_ansi.replace("\n", "_")
-    return wcwidth.wcswidth(s_without_ansi)
+    # Printable ASCII without escapes is one column per character
+    if s.isascii() and s.isprintable():
+        return len(s)
+    return _ansilen_unicode_cached(s)
+
+# Whether the width of s is just the sum of the widths of its characters. Joiners, variation
+# selectors and normalization can change the width of the characters next to them.
+def _widths_add_up(s):
+    return "\u200d" not in s and "\ufe0f" not in s and (s.isascii() or unicodedata.is_normalized('NFC', ANSIRE.sub('', s)))
+
+# Walks s once from start, for strings whose widths add up
+def _split_at_width(s, max_width, start=0):
+    width = 0
+    in_escape = 0  # 1 after ESC, 2 after ESC [, 3 in the parameters
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_escape == 0:
+            if c == "\x1b":
+                in_escape = 1
+            elif c == "\n":
+                width += 1
+            else:
+                c_width = _char_widths.get(c)
+                if c_width is None:
+                    c_width = char_width_unicode(c)
+                if c_width < 0:
+                    # Control characters make every longer prefix -1 wide
+                    return i if -1 > max_width else len(s)
+                width += c_width
+        elif c == "\n" or (in_escape == 1 and c != "["):
+            # An ESC that ANSIRE doesn't strip, so also -1 wide from here on
+            return i if -1 > max_width else len(s)
+        elif in_escape == 1:
+            in_escape = 2
+        elif c == "m" or (in_escape == 2 and c == "K"):
+            in_escape = 0
+        else:
+            in_escape = 3
+        if (width if in_escape == 0 else -1) > max_width:
+            return i
+    return len(s)
+
+# Where to split s so the part before the split is as wide as possible without going over
+# max_width. Gives the same split as checking ansilen_unicode of every prefix: a prefix
+# ending inside an escape sequence is -1 wide, so escapes are never split.
+def ansi_split_at_width(s, max_width):
+    if not _widths_add_up(s):
+        for i in range(len(s)):
+            if ansilen_unicode(s[:i + 1]) > max_width:
+                return i
+        return len(s)
+    return _split_at_width(s, max_width)
 
 class OurTextWrapper:
     """
@@ -235,16 +329,26 @@ class OurTextWrapper:
             # cur_line.append(chunk[:end])
             # reversed_chunks[-1] = chunk[end:]
 
-            # iterative version with ansilen_unicode
-            left_part = ""
-            right_part = chunk
-            for c in chunk:
-                if ansilen_unicode(left_part + c) > space_left:
-                    break
-                left_part += c
-                right_part = right_part[1:]
-            cur_line.append(left_part)
-            reversed_chunks[-1] = right_part
+            # ansilen_unicode aware version
+            split = ansi_split_at_width(chunk, space_left)
+            cur_line.append(chunk[:split])
+            rest = chunk[split:]
+
+            # The following lines would each measure the rest of the chunk again and split
+            # a line off of it. Where widths add up, split it into whole lines right away.
+            pieces = []
+            if chunk[:split].strip() != '' and ansilen_unicode(rest) >= 0 and _widths_add_up(rest):
+                line_width = max(self.width - ansilen_unicode(self.subsequent_indent), 1)
+                start = 0
+                while True:
+                    end = _split_at_width(rest, line_width, start)
+                    if end == start or end == len(rest) or rest[start:end].strip() == '':
+                        break
+                    pieces.append(rest[start:end])
+                    start = end
+                rest = rest[start:]
+            reversed_chunks[-1] = rest
+            reversed_chunks.extend(reversed(pieces))
 
         # Otherwise, we have to preserve the long word intact.  Only add
         # it to the current line if there's nothing already there --
@@ -508,4 +612,48 @@ wrapped = wrap(test_text_with_escapes, 20)
 for line in wrapped:
     print(ansilen_unicode(line), "\x1b[0m" + line)
 print("\x1b[0m")
+
+# Widths should be exactly what wcwidth says, including ZWJ sequences, VS16 and combining characters
+import timeit
+
+def ansilen_unicode_reference(s):
+    s_without_ansi = unicodedata.normalize('NFC', ANSIRE.sub('', s))
+    s_without_ansi = s_without_ansi.replace("\n", "_")
+    return wcwidth.wcswidth(s_without_ansi)
+
+width_cases = [test_text, test_text_with_escapes, "👨\u200d👩\u200d👧", "\u2764\ufe0f", "e\u0301", "\u1100\u1161", "tab\there", "a\nb"]
+width_cases += test_text_with_escapes.split(" ") + wrapped
+print(sum(ansilen_unicode(case) != ansilen_unicode_reference(case) for case in width_cases), "should be 0")
+
+for function in [ansilen_unicode_reference, ansilen_unicode]:
+    times = timeit.repeat(lambda: [function(case) for case in width_cases], number=1000, repeat=5)
+    print(function.__name__, round(min(times) / 1000 / len(width_cases) * 1000000, 2), "us per string")
+
+# Breaking long words: against the old _handle_long_word, which checked the width of every
+# prefix, on words far longer than a line
+class ReferenceTextWrapper(OurTextWrapper):
+    def _handle_long_word(self, reversed_chunks, cur_line, cur_len, width):
+        space_left = 1 if width < 1 else width - cur_len
+        chunk = reversed_chunks[-1]
+        left_part = ""
+        right_part = chunk
+        for c in chunk:
+            if ansilen_unicode(left_part + c) > space_left:
+                break
+            left_part += c
+            right_part = right_part[1:]
+        cur_line.append(left_part)
+        reversed_chunks[-1] = right_part
+
+long_words = {
+    "url": "https://example.org/" + "averylongpathsegment/" * 1000,
+    "cjk": "テストのテキストは長い" * 1000,
+    "hashtag": "#" + "\x1b[1mVery\x1b[0mLong\x1b[38;2;255;0;0mHashtag\x1b[0m" * 1000,
+}
+for name, word in long_words.items():
+    for width in [20, 50]:
+        print(name, width, OurTextWrapper(width=width).wrap(word) == ReferenceTextWrapper(width=width).wrap(word), "should be True")
+        for wrapper in [ReferenceTextWrapper(width=width), OurTextWrapper(width=width)]:
+            times = timeit.repeat(lambda: wrapper.wrap(word), number=3, repeat=3)
+            print(name, width, type(wrapper).__name__, round(min(times) / 3 * 1000, 2), "ms per wrap")
 """
\ No newline at end of file